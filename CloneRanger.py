@@ -1,7 +1,7 @@
-import pandas as pd
 import re
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.metrics.pairwise import cosine_similarity
+from dwc_schema import read_occurrences
 
 # --- Locality Preprocessing ---
 def preprocess_locality(text):
@@ -93,13 +93,11 @@ if __name__ == "__main__":
     file_path = input("Enter the path to your CSV file: ").strip()
 
     try:
-        df = pd.read_csv(file_path)
-        if 'locality' not in df.columns:
-            print("Error: The file does not contain a 'locality' column.")
-        else:
-            df = group_localities(df)
-            output_path = file_path.replace(".csv", "-grouped.csv")
-            df.to_csv(output_path, index=False)
-            print(f"\n✅ Grouped file saved as:\n{output_path}")
+        # Raises a ValueError before parsing if there is no 'locality' column
+        df = read_occurrences(file_path, required=['locality'], encoding='utf-8')
+        df = group_localities(df)
+        output_path = file_path.replace(".csv", "-grouped.csv")
+        df.to_csv(output_path, index=False)
+        print(f"\n✅ Grouped file saved as:\n{output_path}")
     except Exception as e:
         print(f"\n❌ Error: {e}")
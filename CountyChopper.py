@@ -6,6 +6,16 @@ from tqdm import tqdm
 import re
 import argparse
 from pathlib import Path
+from collections import OrderedDict
+from dwc_schema import read_occurrences, NUMERIC_FIELDS
+from parallel_reader import read_occurrences_parallel
+from county_index import build_county_index
+from blacklist_matcher import load_blacklists, blacklisted_records
+
+# The chopper copies records without using their values, so the numeric fields are read as text
+# along with every column outside the registry: values that aren't numbers can't stop the read,
+# and numbers are written out as they appear in the input, in streaming and in-memory mode alike
+TEXT_OVERRIDES = {field: str for field in NUMERIC_FIELDS}
 
 def arg_setup():
     # set up argument parser
@@ -16,6 +26,18 @@ def arg_setup():
         help="Output directory path for multiple CSV files.")
     ap.add_argument("-v", "--verbose", action="store_true", \
         help="Detailed output.")
+    ap.add_argument("-p", "--processes", type=int, default=1, \
+        help="Processes that parse the input file in parallel byte ranges.")
+    ap.add_argument("-g", "--georeference-blacklists", action="store_true", \
+        help="Also drop records on the georeference blacklists in Chopper_Config.txt (whitelisted collections bypass them).")
+    ap.add_argument("--index", action="store_true", \
+        help="Write a county byte-offset index next to the input instead of county CSV files.")
+    ap.add_argument("-s", "--stream", action="store_true", \
+        help="Read the input in chunks and append each chunk to the county files, so memory stays flat.")
+    ap.add_argument("-c", "--chunksize", type=int, default=100000, \
+        help="Rows per chunk in streaming mode.")
+    ap.add_argument("--max-open-files", type=int, default=64, \
+        help="Most county files kept open at once in streaming mode.")
     args = vars(ap.parse_args())
     return args
 
@@ -99,6 +121,66 @@ def sanitize_filename(filename, replacement=''):
     filename = filename[:255]
     return filename
 
+# Per-county output files for streaming mode. At most max_open files stay open; the least
+# recently written one is closed to make room and reopened in append mode if it gets more
+# rows. A file is truncated and given its header the first time it is written.
+class CountyWriterPool:
+    def __init__(self, max_open=64):
+        self.max_open = max(1, max_open)
+        self.handles = OrderedDict()
+        self.started = set()
+
+    def write(self, output_path, rows):
+        handle = self.handles.get(output_path)
+        if handle is not None:
+            self.handles.move_to_end(output_path)
+        else:
+            if len(self.handles) >= self.max_open:
+                _, oldest = self.handles.popitem(last=False)
+                oldest.close()
+            mode = 'a' if output_path in self.started else 'w'
+            handle = self.handles[output_path] = open(output_path, mode, encoding='utf-8', newline='')
+        rows.to_csv(handle, index=False, header=output_path not in self.started)
+        self.started.add(output_path)
+
+    def close(self):
+        while self.handles:
+            self.handles.popitem()[1].close()
+
+# Function to split the input by county in chunks: each chunk is normalized and filtered, and its
+# rows are appended to the county files, so memory use doesn't grow with the input size. Rows
+# keep their input order, and a whitelisted row is written once even if it's also blacklisted.
+def stream_csv_by_county(input_csv, output_dir, state_name, collection_whitelist, collection_blacklist, chunksize=100000, max_open=64,
+                         blacklists=None):
+    chunks = read_occurrences(input_csv, required=['stateProvince', 'county', 'collectionCode'], encoding='utf-8',
+                              on_bad_lines='skip', default_dtype=str, dtype=TEXT_OVERRIDES, chunksize=chunksize)
+    writers = CountyWriterPool(max_open)
+    total_rows = kept_rows = 0
+    try:
+        with tqdm(desc=f"Processing {state_name} Counties", unit=' rows') as progress:
+            for chunk in chunks:
+                chunk['normalized_county'] = chunk['county'].astype(object).apply(normalize_county_name)
+                chunk['collectionCode'] = chunk['collectionCode'].astype(str)
+
+                # Whitelisted records bypass the blacklists
+                keep = ~chunk['collectionCode'].isin(collection_blacklist)
+                if blacklists:
+                    keep &= ~blacklisted_records(chunk, blacklists)
+                keep |= chunk['collectionCode'].isin(collection_whitelist)
+                chunk = chunk[keep]
+
+                for county, county_data in chunk.groupby('normalized_county', sort=False):
+                    output_filename = sanitize_filename(f"{state_name}_{county}.csv", replacement='-')
+                    writers.write(os.path.join(output_dir, output_filename), county_data)
+
+                total_rows += len(keep)
+                kept_rows += len(chunk)
+                progress.update(len(keep))
+    finally:
+        writers.close()
+
+    print(f"Read {total_rows} records, wrote {kept_rows} to {len(writers.started)} county files")
+
 def split_csv_by_state():
     args = arg_setup()
 
@@ -118,18 +200,22 @@ def split_csv_by_state():
     if args['out']:
         print('output path:', args['out'])
         output_dir = Path(args['out']).resolve()
+    elif args['index']:
+        # The index is saved next to the input, so there is no output directory to ask for
+        output_dir = None
     else:
         # Prompt user for output directory
         output_dir = input("Enter the directory where output files should be saved (or press Enter for default): ").strip()
     
-    if not output_dir:
-        #output_dir = f"{state_name.lower()}_counties"
-        output_dir = "chopper_output_counties"
+    if not args['index']:
+        if not output_dir:
+            #output_dir = f"{state_name.lower()}_counties"
+            output_dir = "chopper_output_counties"
 
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
 
-    print(f"Output files will be saved in: {output_dir}")
+        print(f"Output files will be saved in: {output_dir}")
 
     # Load configurations from Chopper_Config.txt
     config = load_configurations()
@@ -142,36 +228,75 @@ def split_csv_by_state():
         print("No state specified in the configuration file. Exiting.")
         return
 
+    # Georeference blacklists from Chopper_Config.txt, compiled once
+    blacklists = load_blacklists() if args['georeference_blacklists'] else None
+
+    if args['index']:
+        if blacklists:
+            print("The county index only applies the collection whitelist and blacklist")
+        # Whitelisted records bypass the blacklist, as in the county files
+        keep_collection = lambda code: code in collection_whitelist or code not in collection_blacklist
+        try:
+            index_file = build_county_index(input_csv, normalize_county_name, keep_collection=keep_collection, encoding='utf-8')
+        except UnicodeDecodeError as e:
+            print(f"Error reading the file: {e}")
+            return
+        print(f"County index saved to {index_file}")
+        return
+
+    if args['stream']:
+        if args['processes'] > 1:
+            print("-p/--processes parses the whole file at once and can't be combined with -s/--stream. Exiting.")
+            return
+        try:
+            stream_csv_by_county(input_csv, output_dir, state_name, collection_whitelist, collection_blacklist,
+                                 chunksize=args['chunksize'], max_open=args['max_open_files'], blacklists=blacklists)
+        except (UnicodeDecodeError, pd.errors.ParserError, ValueError) as e:
+            print(f"Error reading the file: {e}")
+            return
+        print(f"Files created in directory: {output_dir}")
+        return
+
     try:
         #data = pd.read_csv(input_csv, encoding='ISO-8859-1', dtype=str, on_bad_lines='skip', low_memory=False)
-        data = pd.read_csv(input_csv, on_bad_lines='skip', low_memory=False)
+        # Raises a ValueError before parsing if stateProvince, county or collectionCode is missing
+        if args['processes'] > 1:
+            data = read_occurrences_parallel(input_csv, required=['stateProvince', 'county', 'collectionCode'], encoding='utf-8',
+                                             on_bad_lines='skip', default_dtype=str, dtype=TEXT_OVERRIDES,
+                                             processes=args['processes'])
+        else:
+            data = read_occurrences(input_csv, required=['stateProvince', 'county', 'collectionCode'], encoding='utf-8',
+                                    on_bad_lines='skip', default_dtype=str, dtype=TEXT_OVERRIDES)
     except (UnicodeDecodeError, pd.errors.ParserError) as e:
         print(f"Error reading the file: {e}")
         return
 
-    if 'stateProvince' not in data.columns or 'county' not in data.columns or 'collectionCode' not in data.columns:
-        raise ValueError("The CSV file must contain 'stateProvince', 'county', and 'collectionCode' columns.")
-
     # Run the pre-check for missing collectionCode
     #data = count_null_collectioncode(data)
 
-    data['normalized_county'] = data['county'].apply(normalize_county_name)
+    data['normalized_county'] = data['county'].astype(object).apply(normalize_county_name)
 
     # Apply whitelist/blacklist filter for collectionCode
     data['collectionCode'] = data['collectionCode'].astype(str)
     print('Pre-filter data shape:', data.shape)
     
-    # Separate out records that are whitelisted
-    whitelist_data = data[data['collectionCode'].isin(collection_whitelist)]
-    print('whitelist_data shape:', whitelist_data.shape)
+    # Records that are whitelisted
+    whitelisted = data['collectionCode'].isin(collection_whitelist)
+    print('whitelisted records:', whitelisted.sum())
 
     # Exclude records with collectionCode on the blacklist
-    data = data[~data['collectionCode'].isin(collection_blacklist)]
-    print('Blacklist removed data shape:', data.shape)
+    keep = ~data['collectionCode'].isin(collection_blacklist)
+    print('Blacklist removed records:', (~keep).sum())
+
+    # Exclude records on the georeference blacklists
+    if blacklists:
+        keep &= ~blacklisted_records(data, blacklists)
+        print('Records left after the georeference blacklists:', keep.sum())
 
-    # Combine the filtered data with the whitelisted data that bypasses all filters
-    final_data = pd.concat([whitelist_data, data])
-    print('final_data (whitelist_data concat data) shape', final_data.shape)
+    # Whitelisted records bypass all filters; each record is kept at most once, in input order
+    keep |= whitelisted
+    final_data = data[keep]
+    print('final_data shape', final_data.shape)
 
     # Filter for entries only in the selected state and the counties in the list
     #state_data = final_data[(final_data['stateProvince'].str.lower() == state_name.lower()) & (final_data['normalized_county'].isin(county_list))]
@@ -189,4 +314,5 @@ def split_csv_by_state():
     print(f"Files created in directory: {output_dir}")
 
 # Run the function
-split_csv_by_state()
+if __name__ == "__main__":
+    split_csv_by_state()
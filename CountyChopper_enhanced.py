@@ -8,10 +8,26 @@ coordinates and coordinate uncertainty.
 
 import os
 import pandas as pd
+import numpy as np
 from tkinter import Tk
 from tkinter.filedialog import askopenfilename
 from tqdm import tqdm
 import re
+import argparse
+from pathlib import Path
+from dwc_schema import read_occurrences
+from parallel_reader import read_occurrences_parallel
+from blacklist_matcher import compile_blacklists, blacklist_hits
+
+def arg_setup():
+    # set up argument parser
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-i", "--input", required=False, \
+        help="Input path for a single CSV file.")
+    ap.add_argument("-p", "--processes", type=int, default=1, \
+        help="Processes that parse the input file in parallel byte ranges.")
+    args = vars(ap.parse_args())
+    return args
 
 # Function to normalize county names
 def normalize_county_name(county_name):
@@ -81,12 +97,16 @@ def load_configurations():
             filter_coordinate_uncertainty_null, filter_georeferenced_by_and_remarks_null)
 
 def split_csv_by_state():
-    Tk().withdraw()
+    args = arg_setup()
 
-    input_csv = askopenfilename(title="Select the CSV file", filetypes=[("CSV files", "*.csv")])
-    if not input_csv:
-        print("No file selected. Exiting.")
-        return
+    if args['input']:
+        input_csv = Path(args['input']).resolve()
+    else:
+        Tk().withdraw()
+        input_csv = askopenfilename(title="Select the CSV file", filetypes=[("CSV files", "*.csv")])
+        if not input_csv:
+            print("No file selected. Exiting.")
+            return
 
     # Load configurations from Chopper_Config.txt
     config = load_configurations()
@@ -102,70 +122,74 @@ def split_csv_by_state():
         print("No state specified in the configuration file. Exiting.")
         return
 
+    # Columns the filters below always read, plus the ones the enabled filters need
+    required_columns = ['stateProvince', 'county', 'institutionCode', 'locality', 'coordinateUncertaintyInMeters', 'georeferenceSources']
+    if filter_georeferenced_by or filter_georeferenced_by_and_remarks_null:
+        required_columns.append('georeferencedBy')
+    if filter_georeference_remarks or filter_georeferenced_by_and_remarks_null:
+        required_columns.append('georeferenceRemarks')
+
     try:
-        data = pd.read_csv(input_csv, encoding='ISO-8859-1', on_bad_lines='skip', low_memory=False)
+        # Raises a ValueError before parsing if a required column is missing. Columns outside the
+        # registry are read as text, so -p doesn't change how they are written out.
+        if args['processes'] > 1:
+            data = read_occurrences_parallel(input_csv, required=required_columns, encoding='ISO-8859-1', on_bad_lines='skip',
+                                             default_dtype=str, processes=args['processes'])
+        else:
+            data = read_occurrences(input_csv, required=required_columns, encoding='ISO-8859-1', on_bad_lines='skip',
+                                    default_dtype=str)
     except (UnicodeDecodeError, pd.errors.ParserError) as e:
         print(f"Error reading the file: {e}")
         return
 
-    if 'stateProvince' not in data.columns or 'county' not in data.columns or 'institutionCode' not in data.columns or 'locality' not in data.columns:
-        raise ValueError("The CSV file must contain 'stateProvince', 'county', 'institutionCode', and 'locality' columns.")
-
-    data['normalized_county'] = data['county'].apply(normalize_county_name)
+    data['normalized_county'] = data['county'].astype(object).apply(normalize_county_name)
 
     # Apply whitelist/blacklist filter for institutionCode
     data['institutionCode'] = data['institutionCode'].astype(str)
-    
-    # Separate out records that are whitelisted
-    whitelist_data = data[data['institutionCode'].isin(whitelist)]
 
-    # Exclude records with institutionCode on the blacklist
-    data = data[~data['institutionCode'].isin(blacklist)]
+    # Records that are whitelisted bypass all filters
+    whitelisted = data['institutionCode'].isin(whitelist).to_numpy()
 
-    # Include records with null locality only if institutionCode is in the whitelist
-    data_with_locality = data[data['locality'].notnull()]
-    data_null_locality = data[data['locality'].isnull() & data['institutionCode'].isin(whitelist)]
-    filtered_data = pd.concat([data_with_locality, data_null_locality])
-
-    # Apply coordinateUncertaintyInMeters filter
-    filtered_data = filtered_data[
-        (filtered_data['coordinateUncertaintyInMeters'] < coordinate_uncertainty_threshold)
+    # Each filter is a mask of the records it keeps, in the order they are applied
+    filters = [
+        ('institutionCode blacklist', ~data['institutionCode'].isin(blacklist)),
+        ('null locality', data['locality'].notnull()),
+        (f'coordinateUncertaintyInMeters of {coordinate_uncertainty_threshold} or more',
+         data['coordinateUncertaintyInMeters'] < coordinate_uncertainty_threshold)
     ]
-
-    # Apply filter to exclude records with null CoordinateUncertainty if enabled
     if filter_coordinate_uncertainty_null:
-        filtered_data = filtered_data[filtered_data['coordinateUncertaintyInMeters'].notnull()]
-
-    # Apply georeferencedBY and georeferenceRemarks filters if toggled on in the config
+        filters.append(('null coordinateUncertaintyInMeters', data['coordinateUncertaintyInMeters'].notnull()))
     if filter_georeferenced_by:
-        filtered_data = filtered_data[filtered_data['georeferencedBy'].notnull()]
-
+        filters.append(('null georeferencedBy', data['georeferencedBy'].notnull()))
     if filter_georeference_remarks:
-        filtered_data = filtered_data[filtered_data['georeferenceRemarks'].notnull()]
-
-    # Apply the filter that excludes records if both georeferencedBy and georeferenceRemarks are null
+        filters.append(('null georeferenceRemarks', data['georeferenceRemarks'].notnull()))
     if filter_georeferenced_by_and_remarks_null:
-        filtered_data = filtered_data[
-            ~((filtered_data['georeferencedBy'].isnull()) & (filtered_data['georeferenceRemarks'].isnull()))
-        ]
-
-    # Apply georeferenceSourcesBlacklist filter
-    filtered_data = filtered_data[~filtered_data['georeferenceSources'].isin(georeference_sources_blacklist)]
-
-    # Apply georeferenceVerificationStatusBlacklist filter
-    if 'georeferenceVerificationStatus' in filtered_data.columns:
-        filtered_data = filtered_data[~filtered_data['georeferenceVerificationStatus'].isin(georeference_verification_status_blacklist)]
-
-    # Apply georeferenceRemarksBlacklist filter - substring search
-    if 'georeferenceRemarks' in filtered_data.columns:
-        for remark in georeference_remarks_blacklist:
-            filtered_data = filtered_data[~filtered_data['georeferenceRemarks'].str.contains(remark, case=False, na=False)]
-
-    # Combine the filtered data with the whitelisted data that bypasses all filters
-    final_data = pd.concat([whitelist_data, filtered_data])
-
-    # Filter for entries only in the selected state and the counties in the list
-    state_data = final_data[(final_data['stateProvince'].str.lower() == state_name.lower()) & (final_data['normalized_county'].isin(county_list))]
+        filters.append(('null georeferencedBy and georeferenceRemarks',
+                        ~(data['georeferencedBy'].isnull() & data['georeferenceRemarks'].isnull())))
+
+    # Georeference blacklists: exact matches on sources and verification status, and a
+    # case-insensitive search for all remark phrases at once, over the distinct values only
+    blacklists = compile_blacklists(
+        exact={'georeferenceSources': georeference_sources_blacklist,
+               'georeferenceVerificationStatus': georeference_verification_status_blacklist},
+        phrases={'georeferenceRemarks': georeference_remarks_blacklist})
+    for column, hits in blacklist_hits(data, blacklists).items():
+        filters.append((f'{column} blacklist', ~hits))
+
+    # AND the masks together, counting the records each one drops that the earlier ones kept
+    keep = np.ones(len(data), dtype=bool)
+    print(f"Filter stats for {len(data)} records ({whitelisted.sum()} whitelisted records bypass the filters):")
+    for name, mask in filters:
+        mask = np.asarray(mask, dtype=bool)
+        print(f"  {name}: {(keep & ~mask & ~whitelisted).sum()} dropped")
+        keep &= mask
+    keep |= whitelisted
+
+    # Keep only entries in the selected state and the counties in the list
+    in_counties = ((data['stateProvince'].str.lower() == state_name.lower()) & data['normalized_county'].isin(county_list)).to_numpy()
+    print(f"  outside {state_name} or the county list: {(keep & ~in_counties).sum()} dropped")
+    state_data = data[keep & in_counties]
+    print(f"  {len(state_data)} records kept")
 
     output_dir = f'{state_name.lower()}_counties'
     if not os.path.exists(output_dir):
@@ -180,4 +204,5 @@ def split_csv_by_state():
     print(f"Files created in directory: {output_dir}")
 
 # Run the function
-split_csv_by_state()
\ No newline at end of file
+if __name__ == "__main__":
+    split_csv_by_state()
\ No newline at end of file
@@ -3,25 +3,42 @@ import pandas as pd
 from tkinter import Tk
 from tkinter.filedialog import askdirectory
 from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
-from fuzzywuzzy import fuzz
-from datetime import datetime
+from fuzzywuzzy import utils as fuzz_utils
+from rapidfuzz import process as rf_process
+from rapidfuzz.fuzz import ratio as rf_ratio
+import numpy as np
+from dwc_schema import read_occurrences
+from county_index import read_county_rows, county_row_counts
 import time
 import sys
 import re
 import multiprocessing as mp
 import argparse
-from tqdm import tqdm
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import traceback
+import heapq
 import threading
-import queue
+from collections import OrderedDict
 
 def arg_setup():
     # set up argument parser
     ap = argparse.ArgumentParser()
     ap.add_argument("-i", "--input", required=False, \
-        help="Input directory path for CSV files.")
+        help="Input directory path for CSV files, or a single CSV file.")
     ap.add_argument("-v", "--verbose", action="store_true", \
         help="Detailed output.")
+    ap.add_argument("-j", "--jobs", type=int, default=max(1, mp.cpu_count() - 1), \
+        help="Number of CSV files processed at the same time.")
+    ap.add_argument("-c", "--county", action="append", \
+        help="Process only this county of each input file, read through its county index (CountyChopper.py --index). Repeat for more counties.")
+    ap.add_argument("--all-columns", action="store_true", \
+        help="Export every column instead of the fields listed in export_config.txt.")
+    ap.add_argument("-o", "--output", choices=['full', 'sidecar', 'both'], default='full', \
+        help="Write the CSV exports, only the compact group sidecar (.parquet), or both.")
+    ap.add_argument("-e", "--executor", choices=['process', 'thread', 'serial'], default='process', \
+        help="Run the files in a process pool, a thread pool or one after another.")
     args = vars(ap.parse_args())
     return args
 
@@ -47,183 +64,797 @@ def fish_progress_bar(iterable, total=None, desc="Processing"):
     
     sys.stdout.write('\n')  # New line when complete
 
-# Function to extract and normalize compass directions from the locality string
-def extract_compass_direction(locality):
-    if not isinstance(locality, str):  # Ensure locality is a string
-        return None
-    
-    compass_patterns = {
-        'N': r'\b[Nn]orth\b|\b[Nn]\b',
-        'NE': r'\b[Nn]orth[eE]ast\b|\b[Nn][Ee]\b',
-        'E': r'\b[Ee]ast\b|\b[Ee]\b',
-        'SE': r'\b[Ss]outh[eE]ast\b|\b[Ss][Ee]\b',
-        'S': r'\b[Ss]outh\b|\b[Ss]\b',
-        'SW': r'\b[Ss]outh[wW]est\b|\b[Ss][Ww]\b',
-        'W': r'\b[Ww]est\b|\b[Ww]\b',
-        'NW': r'\b[Nn]orth[wW]est\b|\b[Nn][Ww]\b'
-    }
-    
-    for direction, pattern in compass_patterns.items():
-        if re.search(pattern, locality):
+# Compass words, in the priority order used when a locality mentions more than one direction
+COMPASS_DIRECTIONS = ['N', 'NE', 'E', 'SE', 'S', 'SW', 'W', 'NW']
+COMPASS_WORDS = {
+    'north': 'N', 'n': 'N',
+    'northeast': 'NE', 'ne': 'NE',
+    'east': 'E', 'e': 'E',
+    'southeast': 'SE', 'se': 'SE',
+    'south': 'S', 's': 'S',
+    'southwest': 'SW', 'sw': 'SW',
+    'west': 'W', 'w': 'W',
+    'northwest': 'NW', 'nw': 'NW'
+}
+# Single scanner for every compass word (e.g. "North", "northEast", "NE", "n")
+COMPASS_PATTERN = re.compile(r'\b(?:[Nn]orth(?:[eE]ast|[wW]est)?|[Ss]outh(?:[eE]ast|[wW]est)?|[Ee]ast|[Ww]est|[NnSs][EeWw]?|[EeWw])\b')
+
+# Distances with units like km, miles, meters, etc.
+DISTANCE_PATTERN = re.compile(r'(\d+(\.\d+)?)\s*(km|kilometers|miles|mi|meters|m|feet|ft|yards|yd)')
+DISTANCE_UNITS = {
+    'km': 'km', 'kilometers': 'km',
+    'miles': 'miles', 'mi': 'miles',
+    'meters': 'm', 'm': 'm',
+    'feet': 'ft', 'ft': 'ft',
+    'yards': 'yd', 'yd': 'yd'
+}
+
+# Function to pick the normalized compass direction from the compass words found in a locality
+def pick_compass_direction(words):
+    found = {COMPASS_WORDS[word.lower()] for word in words}
+    for direction in COMPASS_DIRECTIONS:
+        if direction in found:
             return direction
     return None
 
-# Function to extract and normalize distances from the locality string
-def extract_distance(locality):
-    if not isinstance(locality, str):  # Ensure locality is a string
-        return None, None
-    
-    # Regular expression to find distances with units like km, miles, meters, etc.
-    distance_pattern = r'(\d+(\.\d+)?)\s*(km|kilometers|miles|mi|meters|m|feet|ft|yards|yd)'
-    
-    match = re.search(distance_pattern, locality)
-    if match:
-        # Extract the number and unit, and normalize the unit
-        distance_value = float(match.group(1))
-        unit = match.group(3).lower()
-        
-        if unit in ['kilometers', 'km']:
-            unit = 'km'
-        elif unit in ['miles', 'mi']:
-            unit = 'miles'
-        elif unit in ['meters', 'm']:
-            unit = 'm'
-        elif unit in ['feet', 'ft']:
-            unit = 'ft'
-        elif unit in ['yards', 'yd']:
-            unit = 'yd'
-        
-        return distance_value, unit
-    return None, None
-
-# Function to calculate similarity between two text fields
-def compare_fields(field1, field2, method='fuzzy', threshold=80, compass1=None, compass2=None, distance1=None, distance2=None):
-    locality_match = False
-    if method == 'fuzzy':
-        locality_match = fuzz.token_sort_ratio(field1, field2) >= threshold
+# Function to extract the locality features used for grouping, once per DataFrame.
+# Every distinct locality is parsed a single time and the results are broadcast back
+# to the records, filling compassDirection, distance, distanceUnit and normalizedLocality.
+def extract_locality_features(df):
+    codes, localities = pd.factorize(df['locality'].astype(object))
+    localities = pd.Series(localities, dtype=object)
+
+    # Compass direction: collect every compass word, then keep the highest priority one
+    found = localities.str.findall(COMPASS_PATTERN)
+    compass = [pick_compass_direction(words) if isinstance(words, list) else None for words in found]
+
+    # Distance and unit from the first distance in the locality
+    parts = localities.str.extract(DISTANCE_PATTERN)
+    distances = [float(value) if isinstance(value, str) else None for value in parts[0]]
+    units = [DISTANCE_UNITS[unit] if isinstance(unit, str) else None for unit in parts[2]]
+
+    # Token-sorted locality as compared by the fuzzy scorer (missing localities score as "nan")
+    normalized = [token_sort_key(locality) for locality in localities]
+
+    # Broadcast to the records; code -1 marks a missing locality
+    def broadcast(values, missing):
+        return pd.Series(np.array(values + [missing], dtype=object)[codes], index=df.index, dtype=object)
+
+    df['compassDirection'] = broadcast(compass, None)
+    df['distance'] = broadcast(distances, None)
+    df['distanceUnit'] = broadcast(units, None)
+    df['normalizedLocality'] = broadcast(normalized, token_sort_key(float('nan')))
+    return df
+
+# Function to normalize a text field the same way fuzz.token_sort_ratio does before scoring
+def token_sort_key(value):
+    processed = fuzz_utils.full_process(value, force_ascii=True)
+    return ' '.join(sorted(processed.split()))
+
+# Function to score pairs of token-sorted strings element by element (left[k] against right[k])
+# in one call. cpdist runs in C++ without the GIL and can spread pairs over several threads.
+# Scores are rounded like fuzzywuzzy's integer ratios so the matches are the same as
+# token_sort_ratio.
+def fuzzy_match_pairs(left, right, threshold, workers=1):
+    scores = rf_process.cpdist(left, right, scorer=rf_ratio, processor=None,
+                               score_cutoff=max(threshold - 1, 0), dtype=np.float64, workers=workers)
+    return np.rint(scores) >= threshold
+
+# Characters of a normalized string are counted in 26 letter bins, 10 digit bins, one space
+# bin and one bin for anything else
+HISTOGRAM_BINS = np.full(128, 37, dtype=np.int64)
+HISTOGRAM_BINS[ord('a'):ord('z') + 1] = np.arange(26)
+HISTOGRAM_BINS[ord('0'):ord('9') + 1] = np.arange(26, 36)
+HISTOGRAM_BINS[ord(' ')] = 36
+
+# Function to count the characters of every string into HISTOGRAM_BINS, one row per string
+def character_histograms(strings):
+    lengths = np.array([len(string) for string in strings], dtype=np.int64)
+    codepoints = np.frombuffer(''.join(strings).encode('utf-32-le'), dtype=np.uint32)
+    bins = HISTOGRAM_BINS[np.minimum(codepoints, 127)]
+    bins[codepoints > 127] = 37
+    rows = np.repeat(np.arange(len(strings)), lengths)
+    counts = np.bincount(rows * 38 + bins, minlength=len(strings) * 38)
+    return counts.reshape(len(strings), 38).astype(np.int32)
+
+# Function to expand "row k pairs with the next counts[k] rows" into explicit pair arrays
+def following_pairs(rows, counts):
+    left = np.repeat(rows, counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return left, left + 1 + offsets
+
+# Function to sort every block by string length and work out how many of the following
+# members each position has to be paired with. The ratio is 200 * common / (len1 + len2)
+# and common can never exceed the shorter length, so once a block is sorted by length every
+# string only has to be paired with the following members up to the longest length that can
+# still reach the cutoff. Returns the members of all blocks laid end to end and the partner
+# count of every position (never past the end of its own block).
+def length_sorted_blocks(blocks, lengths, cutoff):
+    order, partners = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)]
+    for members in blocks:
+        members = np.asarray(members, dtype=np.int64)
+        members = members[np.argsort(lengths[members], kind='stable')]
+        sorted_lengths = lengths[members]
+        if cutoff > 0:
+            longest = sorted_lengths * (200 - cutoff) / cutoff
+            last = np.searchsorted(sorted_lengths, longest + 1e-9, side='right') - 1
+        else:
+            last = np.full(len(members), len(members) - 1)
+        order.append(members)
+        partners.append(np.maximum(last - np.arange(len(members)), 0))
+    return np.concatenate(order), np.concatenate(partners)
+
+# Function to split the sorted positions into (start, stop) tasks of about chunk_size pairs
+def pair_tasks(partners, chunk_size=250000):
+    cumulative = np.cumsum(partners)
+    tasks = []
+    start = 0
+    while start < len(partners):
+        # Take as many positions as fit in one task (always at least one)
+        done = cumulative[start - 1] if start else 0
+        stop = max(start + 1, int(np.searchsorted(cumulative, done + chunk_size, side='right')))
+        tasks.append((start, stop))
+        start = stop
+    return tasks
+
+# Function to score the pairs of one task and return its matching pairs (u < v) with the
+# number of pairs removed, scored and matched. Pairs first go through the cheap character
+# histogram bound and only the survivors are scored; get_strings maps entries to strings.
+def score_pair_task(start, stop, order, partners, lengths, histograms, get_strings, threshold, workers=1):
+    cutoff = threshold - 0.5  # Lowest raw score that can still round up to the threshold
+    left, right = following_pairs(np.arange(start, stop), partners[start:stop])
+    u, v = order[left], order[right]
+    task_stats = {'histogram_bound': 0, 'scored': 0, 'matched': 0}
+    if cutoff > 0 and len(u):
+        # Common characters can't exceed the per-character minimum of both histograms
+        common = np.minimum(histograms[u], histograms[v]).sum(axis=1)
+        keep = 200 * common >= (cutoff - 1e-9) * np.maximum(lengths[u] + lengths[v], 1)
+        task_stats['histogram_bound'] = len(u) - int(keep.sum())
+        u, v = u[keep], v[keep]
+    task_stats['scored'] = len(u)
+    if len(u):
+        matched = fuzzy_match_pairs(get_strings(u), get_strings(v), threshold, workers)
+        u, v = u[matched], v[matched]
+    task_stats['matched'] = len(u)
+    return np.minimum(u, v), np.maximum(u, v), task_stats
+
+# Shared arrays attached by a scoring process: name -> (shared memory block, array view)
+_shared_arrays = {}
+
+# Function to copy arrays into shared memory. Returns the blocks (to close and unlink when
+# done) and the specs a scoring process needs to attach to them.
+def share_arrays(arrays):
+    blocks, specs = [], {}
+    for name, array in arrays.items():
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+        blocks.append(block)
+        specs[name] = (block.name, array.shape, array.dtype.str)
+    return blocks, specs
+
+# Function run once in every scoring process to attach the shared arrays
+def attach_shared_arrays(specs):
+    for name, (block_name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        _shared_arrays[name] = (block, np.ndarray(shape, dtype=dtype, buffer=block.buf))
+
+# Function run in a scoring process to score one task from the shared arrays. Only the
+# strings the task needs are decoded from the shared UTF-8 buffer.
+def score_shared_pair_task(task, threshold):
+    arrays = {name: array for name, (block, array) in _shared_arrays.items()}
+    string_bytes, string_offsets = arrays['string_bytes'], arrays['string_offsets']
+    decoded = {}
+
+    def get_strings(entries):
+        for i in entries.tolist():
+            if i not in decoded:
+                decoded[i] = bytes(string_bytes[string_offsets[i]:string_offsets[i + 1]]).decode('utf-8')
+        return [decoded[i] for i in entries.tolist()]
+
+    start, stop = task
+    return score_pair_task(start, stop, arrays['order'], arrays['partners'], arrays['lengths'],
+                           arrays['histograms'], get_strings, threshold)
+
+# Function to find the matching pairs of every block with the bounded fuzzy scorer. With
+# processes > 1 the pair tasks are spread over a process pool that reads the strings and
+# features from shared memory instead of pickled copies; the pairs come back in task order.
+def fuzzy_block_edges(blocks, strings, threshold, workers=1, processes=1):
+    lengths = np.array([len(string) for string in strings], dtype=np.int64)
+    histograms = character_histograms(strings)
+    blocks = [members for members in blocks if len(members) > 1]
+    order, partners = length_sorted_blocks(blocks, lengths, threshold - 0.5)
+    tasks = pair_tasks(partners)
+
+    pairs = sum(len(members) * (len(members) - 1) // 2 for members in blocks)
+    pair_stats = {'pairs': pairs, 'length_bound': pairs - int(partners.sum()), 'histogram_bound': 0, 'scored': 0, 'matched': 0}
+    if processes > 1 and len(tasks) > 1:
+        encoded = [string.encode('utf-8') for string in strings]
+        shared, specs = share_arrays({
+            'order': order,
+            'partners': partners,
+            'lengths': lengths,
+            'histograms': histograms,
+            'string_bytes': np.frombuffer(b''.join(encoded), dtype=np.uint8),
+            'string_offsets': np.cumsum([0] + [len(string) for string in encoded], dtype=np.int64)
+        })
+        try:
+            with ProcessPoolExecutor(max_workers=processes, initializer=attach_shared_arrays, initargs=(specs,)) as pool:
+                results = list(pool.map(score_shared_pair_task, tasks, [threshold] * len(tasks)))
+        finally:
+            for block in shared:
+                block.close()
+                block.unlink()
+    else:
+        results = [score_pair_task(start, stop, order, partners, lengths, histograms,
+                                   lambda entries: [strings[i] for i in entries], threshold, workers)
+                   for start, stop in tasks]
+
+    edges_u, edges_v = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)]
+    for u, v, task_stats in results:
+        edges_u.append(u)
+        edges_v.append(v)
+        for key, count in task_stats.items():
+            pair_stats[key] += count
+    print(f"{pair_stats['pairs']} pairs: {pair_stats['length_bound']} removed by length, "
+          f"{pair_stats['histogram_bound']} by character counts, {pair_stats['scored']} scored, "
+          f"{pair_stats['matched']} matched")
+    return np.concatenate(edges_u), np.concatenate(edges_v)
+
+# Function to find the matching pairs of every block with TF-IDF cosine similarity. The
+# vectorizer is fitted once on all distinct localities of the file so the IDF weights mean
+# something, and each block is multiplied against itself a few sparse rows at a time.
+# Rows are L2-normalized, so the dot products are the cosine similarities.
+def cosine_block_edges(blocks, strings, threshold, analyzer='char_wb', ngram_range=(3, 3), max_products=5000000):
+    vectors = TfidfVectorizer(analyzer=analyzer, ngram_range=ngram_range).fit_transform(strings)
+    edges_u, edges_v = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)]
+    for members in blocks:
+        if len(members) < 2:
+            continue
+        members = np.asarray(members)
+        block_vectors = vectors[members]
+        block_vectors_t = block_vectors.T.tocsc()
+        chunk_size = max(1, max_products // len(members))  # Never more than max_products similarities at once
+        for start in range(0, len(members), chunk_size):
+            similarities = (block_vectors[start:start + chunk_size] @ block_vectors_t).tocoo()
+            rows = similarities.row + start
+            # Keep each pair once (later member) and only the ones above the threshold
+            keep = (similarities.col > rows) & (similarities.data >= threshold / 100)
+            edges_u.append(members[rows[keep]])
+            edges_v.append(members[similarities.col[keep]])
+    return np.concatenate(edges_u), np.concatenate(edges_v)
+
+# Prime just above 2**32 for the MinHash permutations (a * hash + b) % MINHASH_PRIME
+MINHASH_PRIME = np.uint64(4294967311)
+
+# Function to hash every character shingle of every string. Returns the 32-bit shingle hashes
+# and how many shingles each string has; strings shorter than the shingle size are one shingle.
+def shingle_hashes(strings, shingle_size=3):
+    lengths = np.array([len(string) for string in strings], dtype=np.int64)
+    codepoints = np.frombuffer(''.join(strings).encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+    ends = np.cumsum(lengths)
+    counts = np.where(lengths >= shingle_size, lengths - shingle_size + 1, np.minimum(lengths, 1))
+
+    # Start position of every shingle in the joined codepoints
+    starts = np.repeat(ends - lengths, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    shingle_ends = np.repeat(ends, counts)
+    hashes = np.zeros(len(starts), dtype=np.uint64)
+    for offset in range(shingle_size):
+        positions = starts + offset
+        inside = positions < shingle_ends
+        hashes = hashes * np.uint64(1000003) + np.where(inside, codepoints[np.minimum(positions, len(codepoints) - 1)], 0)
+    # Mix the high bits down and keep 32 bits
+    return (hashes * np.uint64(0x9E3779B97F4A7C15)) >> np.uint64(32), counts
+
+# Function to compute MinHash signatures (one row per string) with NumPy, a chunk of shingles at a time
+def minhash_signatures(strings, num_perm=128, shingle_size=3, seed=1, chunk_size=50000):
+    rng = np.random.default_rng(seed)
+    # Keep a and b below 2**32 so a * hash + b can't overflow 64 bits
+    a = rng.integers(1, 2 ** 32, size=num_perm, dtype=np.uint64)[:, None]
+    b = rng.integers(0, 2 ** 32, size=num_perm, dtype=np.uint64)[:, None]
+    hashes, counts = shingle_hashes(strings, shingle_size)
+
+    # Strings without shingles (empty) keep the maximum value in every position
+    signatures = np.full((len(strings), num_perm), MINHASH_PRIME, dtype=np.uint64)
+    with_shingles = np.flatnonzero(counts)
+    offsets = np.concatenate([[0], np.cumsum(counts[with_shingles])])
+    start = 0
+    while start < len(with_shingles):
+        stop = max(start + 1, int(np.searchsorted(offsets, offsets[start] + chunk_size, side='right')) - 1)
+        values = (a * hashes[offsets[start]:offsets[stop]] + b) % MINHASH_PRIME
+        signatures[with_shingles[start:stop]] = np.minimum.reduceat(values, offsets[start:stop] - offsets[start], axis=1).T
+        start = stop
+    return signatures
+
+# Function to choose LSH bands and rows for a target recall: the chance that a pair with
+# Jaccard similarity s shares at least one band is 1 - (1 - s**rows)**bands. Picks the most
+# rows per band (fewest candidates) that still reaches the recall at the given similarity.
+def choose_lsh_bands(num_perm, jaccard, recall):
+    for rows in range(num_perm, 0, -1):
+        bands = num_perm // rows
+        if 1 - (1 - jaccard ** rows) ** bands >= recall:
+            return bands, rows
+    return num_perm, 1
+
+# Function to generate candidate pairs (u < v) with MinHash LSH. Entries only become
+# candidates when they share a band bucket and are in the same block.
+def lsh_candidate_pairs(strings, entry_blocks, bands, rows, shingle_size=3, seed=1):
+    signatures = minhash_signatures(strings, num_perm=bands * rows, shingle_size=shingle_size, seed=seed)
+    candidates = [np.empty(0, dtype=np.int64)]
+    for band in range(bands):
+        # Bucket every entry on its block and the signature values of this band
+        band_keys = np.column_stack([entry_blocks.astype(np.uint64), signatures[:, band * rows:(band + 1) * rows]])
+        buckets = np.unique(band_keys, axis=0, return_inverse=True)[1].ravel()
+        order = np.argsort(buckets, kind='stable')
+        bucket_ends = np.searchsorted(buckets[order], buckets[order], side='right')
+        # Every entry pairs with the entries after it in the same bucket
+        left, right = following_pairs(np.arange(len(order)), bucket_ends - np.arange(len(order)) - 1)
+        u, v = order[left], order[right]
+        candidates.append(np.minimum(u, v) * len(strings) + np.maximum(u, v))
+    candidates = np.unique(np.concatenate(candidates))
+    return candidates // len(strings), candidates % len(strings)
+
+# Function to find the matching pairs of every block from MinHash LSH candidates only.
+# Candidates are verified with the same rounded token sort ratio as the exact scorer.
+def lsh_fuzzy_edges(blocks, strings, threshold, num_perm=128, bands=0, rows=0, jaccard=0.7, recall=0.95, workers=1, chunk_size=250000):
+    if not (bands and rows):
+        bands, rows = choose_lsh_bands(num_perm, jaccard, recall)
+    entry_blocks = np.empty(len(strings), dtype=np.int64)
+    for block, members in enumerate(blocks):
+        entry_blocks[members] = block
+    candidates_u, candidates_v = lsh_candidate_pairs(strings, entry_blocks, bands, rows)
+
+    possible = sum(len(members) * (len(members) - 1) // 2 for members in blocks)
+    print(f"LSH with {bands} bands x {rows} rows (expected recall {1 - (1 - jaccard ** rows) ** bands:.1%} "
+          f"at Jaccard {jaccard}): {len(candidates_u)} candidate pairs out of {possible} possible")
+
+    matched = np.zeros(len(candidates_u), dtype=bool)
+    for start in range(0, len(candidates_u), chunk_size):
+        u, v = candidates_u[start:start + chunk_size], candidates_v[start:start + chunk_size]
+        matched[start:start + chunk_size] = fuzzy_match_pairs([strings[i] for i in u], [strings[j] for j in v], threshold, workers)
+    return candidates_u[matched], candidates_v[matched]
+
+# Function to reproduce the greedy seed scan from a list of matching pairs (u < v): in
+# order, every unassigned entry starts a group and claims its unassigned later matches.
+# Only entries with later matches can claim anything, so the scan visits just those; every
+# entry left unclaimed at the end is the seed of its own group.
+def greedy_groups_from_edges(size, edges_u, edges_v):
+    order = np.lexsort((edges_v, edges_u))
+    edges_u, edges_v = edges_u[order], edges_v[order]
+    offsets = np.searchsorted(edges_u, np.arange(size + 1))
+
+    seeds = np.full(size, -1, dtype=np.int64)
+    for i in np.flatnonzero(offsets[1:] != offsets[:-1]).tolist():
+        if seeds[i] != -1:  # Skip if this entry has already been assigned a group
+            continue
+        seeds[i] = i  # Start a new group with this entry
+        claimed = edges_v[offsets[i]:offsets[i + 1]]
+        seeds[claimed[seeds[claimed] == -1]] = i  # Assign the same group to similar entries
+    unclaimed = np.flatnonzero(seeds == -1)
+    seeds[unclaimed] = unclaimed
+    return seeds
+
+# Function to merge matching pairs into connected groups with an array-backed union-find.
+# Every entry ends up pointing at the smallest entry of its group, which acts as its seed.
+def union_find_groups(size, edges_u, edges_v):
+    parent = list(range(size))
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]  # Path halving
+            x = parent[x]
+        return x
+
+    for u, v in zip(edges_u.tolist(), edges_v.tolist()):
+        root_u, root_v = find(u), find(v)
+        if root_u < root_v:
+            parent[root_v] = root_u
+        elif root_v < root_u:
+            parent[root_u] = root_v
+    return np.array([find(x) for x in range(size)], dtype=np.int64)
+
+# Function to turn matching pairs into a seed entry for every entry. "greedy" reproduces the
+# original seed scan (a record only joins the seed it matches); "connected" also joins
+# records that are linked through other matches.
+def groups_from_edges(size, edges_u, edges_v, mode='greedy'):
+    if mode == 'greedy':
+        return greedy_groups_from_edges(size, edges_u, edges_v)
+    elif mode == 'connected':
+        return union_find_groups(size, edges_u, edges_v)
+    raise ValueError(f"Unknown grouping mode '{mode}' in export_config.txt.")
+
+# Function to find the matching pairs (u < v) of every block with the configured scorer.
+# Any scorer works as long as it returns every matching pair of entries.
+def find_match_edges(blocks, strings, similarity_threshold, method='fuzzy', candidate_pairs='blocks', workers=1, processes=1,
+                     cosine_analyzer='char_wb', cosine_ngram_range=(3, 3),
+                     lsh_num_perm=128, lsh_bands=0, lsh_rows=0, lsh_jaccard=0.7, lsh_recall=0.95):
+    if method == 'fuzzy' and candidate_pairs == 'lsh':
+        return lsh_fuzzy_edges(blocks, strings, similarity_threshold, lsh_num_perm, lsh_bands, lsh_rows,
+                               lsh_jaccard, lsh_recall, workers=workers)
+    elif method == 'fuzzy':
+        return fuzzy_block_edges(blocks, strings, similarity_threshold, workers=workers, processes=processes)
     elif method == 'cosine':
-        vectorizer = TfidfVectorizer().fit_transform([field1, field2])
-        cosine_sim = cosine_similarity(vectorizer[0:1], vectorizer[1:2])
-        locality_match = cosine_sim[0][0] >= threshold / 100
-    
-    # Check if compass directions and distances match exactly
-    compass_match = compass1 == compass2
-    distance_match = distance1 == distance2
-    
-    return locality_match and compass_match and distance_match
+        edges_u, edges_v = cosine_block_edges(blocks, strings, similarity_threshold,
+                                              analyzer=cosine_analyzer, ngram_range=cosine_ngram_range)
+        print(f"{len(edges_u)} pairs above cosine similarity {similarity_threshold / 100:.2f}")
+        return edges_u, edges_v
+    raise ValueError(f"Unknown similarity method '{method}' in export_config.txt.")
+
+# Function to build the blocking key for every record. Records can only match when
+# their compass direction, distance and unit are identical, so only records that
+# share a key are ever compared. Extra keys come from export_config.txt.
+def build_blocking_keys(df, compass_directions, distances, blocking_keys=None):
+    extra_columns = []
+    for key in blocking_keys or []:
+        if key == 'locality_token':
+            # First word of the locality, e.g. "Lubbock" in "Lubbock, 5 mi N"
+            values = df['locality'].astype(object).str.extract(r'(\w+)', expand=False).str.lower()
+        elif key in df.columns:
+            values = df[key].astype(object)
+        else:
+            raise ValueError(f"Unknown blocking key '{key}' in export_config.txt.")
+        extra_columns.append(values.where(values.notna(), None).tolist())
+
+    return list(zip(compass_directions, distances, *extra_columns))
+
+# Function to collapse records into unique (blocking key, locality) entries. Returns the
+# unique entries in first-occurrence order, the first record of each entry, how many
+# records share it, and the entry code of every record.
+def collapse_unique_localities(block_keys, locality_keys):
+    unique_index = {}
+    first_records = []
+    codes = np.empty(len(block_keys), dtype=np.int64)
+    for position, key in enumerate(zip(block_keys, locality_keys)):
+        code = unique_index.get(key)
+        if code is None:  # First time this exact locality is seen
+            code = unique_index[key] = len(first_records)
+            first_records.append(position)
+        codes[position] = code
+    counts = np.bincount(codes, minlength=len(first_records))
+    return list(unique_index), first_records, counts, codes
 
 # Modify the find_potential_duplicates function to include compass and distance extraction
-def find_potential_duplicates(df, similarity_threshold, method='fuzzy'):
-    groups = []
-    group_id = 1
-    assigned_groups = [-1] * len(df)  # Initialize all records as ungrouped
-    
-    # Add columns for compass direction and distance
-    df['compassDirection'] = None
-    df['distance'] = None
-    df['distanceUnit'] = None
-    
-    #for i, row1 in fish_progress_bar(df.iterrows(), total=len(df), desc="Building groups"):
-    for i, row1 in df.iterrows():
-        if assigned_groups[i] != -1:  # Skip if this record has already been assigned a group
-            continue
-        current_group = [i]  # Start a new group with this record
-        assigned_groups[i] = group_id  # Assign group ID to this record
-        
-        # Extract compass direction and distance for this record
-        compass1 = extract_compass_direction(row1['locality'])
-        distance1, unit1 = extract_distance(row1['locality'])
-        
-        # Save the extracted data to the DataFrame
-        df.at[i, 'compassDirection'] = compass1
-        df.at[i, 'distance'] = distance1
-        df.at[i, 'distanceUnit'] = unit1
-        
-        for j, row2 in df.iterrows():
-            if i >= j or assigned_groups[j] != -1:
-                continue  # Skip the same record or already assigned records
-            
-            # Extract compass direction and distance for the second record
-            compass2 = extract_compass_direction(row2['locality'])
-            distance2, unit2 = extract_distance(row2['locality'])
-            
-            # Only compare if both records have matching distance units
-            if unit1 == unit2:
-                if compare_fields(row1['locality'], row2['locality'], method, similarity_threshold,
-                                  compass1=compass1, compass2=compass2,
-                                  distance1=(distance1, unit1), distance2=(distance2, unit2)):
-                    current_group.append(j)
-                    assigned_groups[j] = group_id  # Assign the same group ID to similar records
-                    
-                    # Save the extracted data to the DataFrame
-                    df.at[j, 'compassDirection'] = compass2
-                    df.at[j, 'distance'] = distance2
-                    df.at[j, 'distanceUnit'] = unit2
-        
-        groups.append(current_group)  # Add the group to the list
-        group_id += 1  # Increment the group ID for the next group
-    
+def find_potential_duplicates(df, similarity_threshold, method='fuzzy', blocking_keys=None, workers=1, processes=1, grouping_mode='greedy',
+                              cosine_analyzer='char_wb', cosine_ngram_range=(3, 3), candidate_pairs='blocks',
+                              lsh_num_perm=128, lsh_bands=0, lsh_rows=0, lsh_jaccard=0.7, lsh_recall=0.95):
+    # The loops below only read the precomputed locality features
+    if 'normalizedLocality' not in df.columns:
+        extract_locality_features(df)
+    compass_directions = df['compassDirection'].tolist()
+    distances = list(zip(df['distance'], df['distanceUnit']))
+    block_keys = build_blocking_keys(df, compass_directions, distances, blocking_keys)
+
+    # Identical localities always score 100 and share every other key, so they always end
+    # up in the group of their first copy. Only the distinct entries need to be scored.
+    locality_keys = df['normalizedLocality'].tolist()
+    unique_keys, first_records, counts, codes = collapse_unique_localities(block_keys, locality_keys)
+    print(f"{len(unique_keys)} distinct localities for {len(df)} records")
+
+    # Hash every distinct locality into its block
+    blocks = {}
+    for u, (block_key, locality_key) in enumerate(unique_keys):
+        blocks.setdefault(block_key, []).append(u)
+
+    # Stage one: score the blocks into a list of matching pairs
+    unique_localities = [locality_key for block_key, locality_key in unique_keys]
+    edges_u, edges_v = find_match_edges(list(blocks.values()), unique_localities, similarity_threshold,
+                                        method=method, candidate_pairs=candidate_pairs, workers=workers, processes=processes,
+                                        cosine_analyzer=cosine_analyzer, cosine_ngram_range=cosine_ngram_range,
+                                        lsh_num_perm=lsh_num_perm, lsh_bands=lsh_bands, lsh_rows=lsh_rows,
+                                        lsh_jaccard=lsh_jaccard, lsh_recall=lsh_recall)
+
+    # Stage two: turn the pairs into groups
+    seeds = groups_from_edges(len(unique_keys), edges_u, edges_v, mode=grouping_mode)
+
+    # Number the groups in seed order so the IDs match a full scan of the file, then
+    # broadcast them from the distinct entries back to every record
+    is_seed = seeds == np.arange(len(seeds))
+    entry_group_ids = np.cumsum(is_seed)[seeds]
+    assigned_groups = entry_group_ids[codes].astype(np.int32)
+
+    # Records of every group in record order
+    order = np.argsort(assigned_groups, kind='stable')
+    boundaries = np.cumsum(np.bincount(assigned_groups, minlength=int(is_seed.sum()) + 1))[1:-1]
+    groups = [members.tolist() for members in np.split(order, boundaries)] if len(assigned_groups) else []
+
     return groups, assigned_groups
 
-# Function to assign sub-groups based on similar eventDate, recordNumber, and habitat values
-def assign_sub_groups(df, eventdate_tolerance=3, recordnumber_tolerance=5, habitat_similarity_threshold=80, handle_null_recordnumber='0', handle_null_eventdate='0'):
-    sub_groups = [-1] * len(df)
+# Pattern of an eventDate: an ISO date that may be partial (YYYY, YYYY-MM or YYYY-MM-DD),
+# optionally followed by "/" and the end of a Darwin Core date range
+EVENT_DATE_PATTERN = r'^\s*(\d{4})(?:-(\d{1,2})(?:-(\d{1,2}))?)?(?:/(\d{4})(?:-(\d{1,2})(?:-(\d{1,2}))?)?)?\s*$'
+
+# Function to turn the year, month and day columns of partial dates into the number (days since
+# 1970-01-01) of the first (or last) day each one covers; a missing month or day widens the date
+# to the whole year or month. The days are counted with numpy's datetime64 rather than pandas
+# timestamps, which stop at 1677-2262, so every four-digit year works as it did with strptime.
+# Returns the day numbers and a mask of the real dates.
+def partial_date_bounds(year, month, day, last=False):
+    year, month, day = (column.to_numpy(dtype=np.float64) for column in (year, month, day))
+    month = np.where(np.isnan(month), 12 if last else 1, month)
+    valid = (year >= 1) & (month >= 1) & (month <= 12)
+    months = np.where(valid, (year - 1970) * 12 + month - 1, 0).astype(np.int64).astype('datetime64[M]')
+    first_days = months.astype('datetime64[D]').astype(np.int64)
+    month_lengths = (months + 1).astype('datetime64[D]').astype(np.int64) - first_days
+    day = np.where(np.isnan(day), month_lengths if last else 1, day)
+    valid &= (day >= 1) & (day <= month_lengths)
+    return np.where(valid, first_days + day - 1, 0).astype(np.int64), valid
+
+# Function to parse every eventDate once into the first and last day number it covers. Dates
+# can be ISO dates, partial dates (YYYY-MM, YYYY) or ranges ("1990-05-01/1990-05-03").
+# Returns the start days, end days and a mask of the dates that parsed; missing dates,
+# impossible dates and ranges that end before they start count as null.
+def parse_event_dates(event_dates):
+    parts = pd.Series(event_dates, dtype=object).str.extract(EVENT_DATE_PATTERN).apply(pd.to_numeric)
+    start_days, starts_valid = partial_date_bounds(parts[0], parts[1], parts[2])
+    # A single date ends where it starts; a range ends at its second date
+    ranged = parts[3].notna()
+    end_days, ends_valid = partial_date_bounds(parts[3].where(ranged, parts[0]), parts[4].where(ranged, parts[1]),
+                                               parts[5].where(ranged, parts[2]), last=True)
+    present = starts_valid & ends_valid & (end_days >= start_days)
+    return np.where(present, start_days, 0), np.where(present, end_days, 0), present
+
+# Function to find the candidate windows of one tolerance test within a group. Values are
+# intervals (start, end; a single value has start == end) and the difference of two of them
+# is the gap between them. Present values are sorted by start and each one is paired with
+# the following values that start by its end + tolerance (with a little slack for float
+# rounding; the exact test is applied to the pairs afterwards). When nulls match everything,
+# every null also pairs with every other record.
+# Returns (sorted rows, partner counts, null rows, present rows, number of pairs).
+def tolerance_windows(starts, ends, present, tolerance, nulls_match):
+    sweep = present & np.isfinite(starts) & np.isfinite(ends)  # inf never lies within a finite tolerance
+    rows = np.flatnonzero(sweep)
+    rows = rows[np.argsort(starts[rows], kind='stable')]
+    sorted_starts = starts[rows]
+    slack = 1e-9 * max(1.0, float(np.abs(ends[rows]).max())) if len(rows) else 0.0
+    last = np.searchsorted(sorted_starts, ends[rows] + tolerance + slack, side='right') - 1
+    partners = np.maximum(last - np.arange(len(rows)), 0)
+
+    null_rows = np.flatnonzero(~present) if nulls_match else np.empty(0, dtype=np.int64)
+    present_rows = np.flatnonzero(present) if nulls_match else np.empty(0, dtype=np.int64)
+    nulls = len(null_rows)
+    pair_count = int(partners.sum()) + nulls * len(present_rows) + nulls * (nulls - 1) // 2
+    return rows, partners, null_rows, present_rows, pair_count
+
+# Function to list the candidate pairs (u < v) of tolerance windows
+def tolerance_window_pairs(rows, partners, null_rows, present_rows, pair_count):
+    left, right = following_pairs(np.arange(len(rows)), partners)
+    u, v = [rows[left]], [rows[right]]
+    if len(null_rows):
+        u.append(np.repeat(null_rows, len(present_rows)))
+        v.append(np.tile(present_rows, len(null_rows)))
+        left, right = following_pairs(np.arange(len(null_rows)), len(null_rows) - 1 - np.arange(len(null_rows)))
+        u.append(null_rows[left])
+        v.append(null_rows[right])
+    u, v = np.concatenate(u), np.concatenate(v)
+    return np.minimum(u, v), np.maximum(u, v)
+
+# Function to apply one tolerance test to pairs, the same way the pairwise comparison does:
+# a pair with a null value has no difference when nulls match and an infinite one otherwise
+def within_tolerance(starts, ends, present, tolerance, nulls_match, u, v):
+    both = present[u] & present[v]
+    with np.errstate(invalid='ignore'):
+        gap = np.maximum(np.maximum(starts[v] - ends[u], starts[u] - ends[v]), 0)
+        close = gap <= tolerance
+    return np.where(both, close, nulls_match)
+
+# Most habitat pair scores remembered between groups and files (least recently used go first)
+HABITAT_CACHE_SIZE = 200000
+_habitat_scores = OrderedDict()
+_habitat_scores_lock = threading.Lock()
+
+# Function to score pairs of token-sorted habitats, rounded like token_sort_ratio. Scores are
+# kept in a bounded LRU cache, so habitat pairs that repeat across groups and files are only
+# scored once; the pairs that aren't cached yet are scored together in one batch.
+def cached_habitat_scores(left, right, workers=1, cache_size=HABITAT_CACHE_SIZE):
+    pairs = [(a, b) if a <= b else (b, a) for a, b in zip(left, right)]  # The ratio is symmetric
+    scores = np.zeros(len(pairs), dtype=np.int64)
+    missing = {}
+    with _habitat_scores_lock:
+        for k, pair in enumerate(pairs):
+            score = _habitat_scores.get(pair)
+            if score is None:
+                missing.setdefault(pair, []).append(k)
+            else:
+                _habitat_scores.move_to_end(pair)
+                scores[k] = score
+    if missing:
+        missing_pairs = list(missing)
+        new_scores = rf_process.cpdist([a for a, b in missing_pairs], [b for a, b in missing_pairs], scorer=rf_ratio,
+                                       processor=None, dtype=np.float64, workers=workers)
+        new_scores = np.rint(new_scores).astype(np.int64).tolist()
+        with _habitat_scores_lock:
+            for pair, score in zip(missing_pairs, new_scores):
+                scores[missing[pair]] = score
+                _habitat_scores[pair] = score
+            while len(_habitat_scores) > cache_size:
+                _habitat_scores.popitem(last=False)
+    return scores
+
+# Function to find the sub-group seed of every record in one group. Candidate pairs come from
+# sorted windows over whichever of eventDate and recordNumber gives fewer pairs, then the
+# other tolerance is checked and the habitat score is only looked up for pairs that pass both.
+def sub_group_seeds(start_days, end_days, day_present, records, record_present, habitat_codes, habitat_keys, eventdate_tolerance,
+                    recordnumber_tolerance, habitat_similarity_threshold, handle_null_recordnumber='0',
+                    handle_null_eventdate='0', workers=1):
+    size = len(start_days)
+    tests = [(start_days, end_days, day_present, eventdate_tolerance, handle_null_eventdate == '0'),
+             (records, records, record_present, recordnumber_tolerance, handle_null_recordnumber == '0')]
+    windows = [tolerance_windows(*test) for test in tests]
+    first = 0 if windows[0][-1] <= windows[1][-1] else 1
+    u, v = tolerance_window_pairs(*windows[first])
+
+    # Cheap numeric tolerances first (both again, exactly), then the habitat score
+    for test in tests:
+        keep = within_tolerance(*test, u, v)
+        u, v = u[keep], v[keep]
+    codes_u, codes_v = habitat_codes[u], habitat_codes[v]
+    habitat_match = np.full(len(u), 0 >= habitat_similarity_threshold)  # A missing habitat scores 0
+    scored = (codes_u != -1) & (codes_v != -1)
+    if scored.any():
+        code_pairs, inverse = np.unique(np.stack([codes_u[scored], codes_v[scored]], axis=1), axis=0, return_inverse=True)
+        matched = cached_habitat_scores([habitat_keys[c] for c in code_pairs[:, 0]], [habitat_keys[c] for c in code_pairs[:, 1]],
+                                        workers) >= habitat_similarity_threshold
+        habitat_match[scored] = matched[inverse.ravel()]
+    return greedy_groups_from_edges(size, u[habitat_match], v[habitat_match])
+
+# Function to split groups into batches of about equal cost (candidate pairs grow with the
+# square of the group size): largest groups first, each into the currently cheapest batch.
+# Returns the group positions of every batch in ascending order.
+def balanced_batches(sizes, batch_count):
+    heap = [(0, b) for b in range(batch_count)]
+    batches = [[] for _ in range(batch_count)]
+    for k in np.argsort(-np.asarray(sizes, dtype=np.int64) ** 2, kind='stable'):
+        cost, b = heapq.heappop(heap)
+        batches[b].append(int(k))
+        heapq.heappush(heap, (cost + int(sizes[k]) ** 2, b))
+    return [sorted(batch) for batch in batches if batch]
+
+# Function to find the sub-group seeds of a batch of groups (run in a worker process). Each
+# group is a tuple of its column slices; habitat codes index habitat_keys.
+def sub_group_seeds_batch(groups, habitat_keys, settings):
+    return [sub_group_seeds(*group, habitat_keys, **settings) for group in groups]
+
+# Function to assign sub-groups based on similar eventDate, recordNumber, and habitat values.
+# Groups are independent, so with processes > 1 they are scored in size-balanced batches on a
+# process pool; sub-group IDs are numbered afterwards in group order either way.
+def assign_sub_groups(df, eventdate_tolerance=3, recordnumber_tolerance=5, habitat_similarity_threshold=80, handle_null_recordnumber='0', handle_null_eventdate='0', workers=1, processes=1):
+    sub_groups = np.full(len(df), -1, dtype=np.int32)
     sub_group_id = 1
     
     # Convert recordNumber to numeric for comparison, setting non-convertible values to NaN
-    df['recordNumber'] = pd.to_numeric(df['recordNumber'], errors='coerce')
-    
-    #for group_id in fish_progress_bar(df['Group_ID'].unique(), desc="Assigning sub-groups"):
-    for group_id in df['Group_ID'].unique():
-        group_df = df[df['Group_ID'] == group_id]
-        for i, row1 in group_df.iterrows():
-            if sub_groups[i] != -1:  # Skip if already assigned a sub-group
-                continue
-            sub_group = [i]
-            sub_groups[i] = sub_group_id
-            
-            for j, row2 in group_df.iterrows():
-                if i >= j or sub_groups[j] != -1:
-                    continue
-                
-                # Safely parse eventDate (set to a default if invalid)
-                try:
-                    date1 = datetime.strptime(row1['eventDate'], '%Y-%m-%d') if pd.notna(row1['eventDate']) else None
-                    date2 = datetime.strptime(row2['eventDate'], '%Y-%m-%d') if pd.notna(row2['eventDate']) else None
-                except ValueError:
-                    date1, date2 = None, None
-                
-                # Handle eventDate comparison based on the config setting
-                if date1 is None or date2 is None:
-                    if handle_null_eventdate == '0':
-                        date_diff = 0  # Treat nulls as no difference
-                    else:
-                        date_diff = float('inf')  # Treat nulls as infinite difference
-                else:
-                    date_diff = abs((date1 - date2).days)
+    df['recordNumber'] = pd.to_numeric(df['recordNumber'].astype(object), errors='coerce')
 
-                # Handle recordNumber comparison based on the config setting
-                if pd.isna(row1['recordNumber']) or pd.isna(row2['recordNumber']):
-                    if handle_null_recordnumber == '0':
-                        record_diff = 0  # Treat nulls as no difference
-                    else:
-                        record_diff = float('inf')  # Treat nulls as infinite difference
-                else:
-                    record_diff = abs(row1['recordNumber'] - row2['recordNumber'])
-                
-                # Handle habitat similarity
-                habitat_similarity = fuzz.token_sort_ratio(row1['habitat'], row2['habitat']) if pd.notna(row1['habitat']) and pd.notna(row2['habitat']) else 0
-                habitat_match = habitat_similarity >= habitat_similarity_threshold
-                
-                # Check if both date, record number differences are within tolerance, and habitat is similar
-                if date_diff <= eventdate_tolerance and record_diff <= recordnumber_tolerance and habitat_match:
-                    sub_group.append(j)
-                    sub_groups[j] = sub_group_id
-            
-            sub_group_id += 1  # Increment sub-group ID for the next sub-group
+    # Parse dates, record numbers and habitats once for every record
+    start_days, end_days, day_present = parse_event_dates(df['eventDate'].tolist())
+    records = df['recordNumber'].to_numpy(dtype=np.float64)
+    record_present = ~np.isnan(records)
+    habitat_keys = [token_sort_key(habitat) if pd.notna(habitat) else None for habitat in df['habitat']]
+    habitat_codes, unique_habitats = pd.factorize(pd.Series(habitat_keys, dtype=object))
+    unique_habitats = list(unique_habitats)
+    columns = (start_days, end_days, day_present, records, record_present, habitat_codes)
+    settings = {
+        'eventdate_tolerance': eventdate_tolerance,
+        'recordnumber_tolerance': recordnumber_tolerance,
+        'habitat_similarity_threshold': habitat_similarity_threshold,
+        'handle_null_recordnumber': handle_null_recordnumber,
+        'handle_null_eventdate': handle_null_eventdate,
+        'workers': workers
+    }
+
+    # Partition the records once: members of every group in first-appearance order of the groups
+    group_codes, _ = pd.factorize(df['Group_ID'])
+    order = np.argsort(group_codes, kind='stable')
+    groups = np.split(order, np.cumsum(np.bincount(group_codes))[:-1]) if len(df) else []
+
+    # Only groups with more than one record need scoring
+    seeds = [np.zeros(1, dtype=np.int64) if len(members) == 1 else None for members in groups]
+    scored = [k for k, members in enumerate(groups) if len(members) > 1]
+    if processes > 1 and len(scored) > 1:
+        batches = [[scored[k] for k in batch]
+                   for batch in balanced_batches([len(groups[k]) for k in scored], processes * 4)]
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            futures = []
+            for batch in batches:
+                # Send only the column slices and habitats the batch needs
+                batch_codes = np.concatenate([habitat_codes[groups[k]] for k in batch])
+                used = np.unique(batch_codes[batch_codes != -1])
+                batch_groups = []
+                for k in batch:
+                    group = [column[groups[k]] for column in columns]
+                    group[-1] = np.where(group[-1] == -1, -1, np.searchsorted(used, group[-1]))
+                    batch_groups.append(tuple(group))
+                futures.append(pool.submit(sub_group_seeds_batch, batch_groups,
+                                           [unique_habitats[c] for c in used], settings))
+            for batch, future in zip(batches, futures):
+                for k, group_seeds in zip(batch, future.result()):
+                    seeds[k] = group_seeds
+    else:
+        for k in scored:
+            seeds[k] = sub_group_seeds(*[column[groups[k]] for column in columns], unique_habitats, **settings)
+
+    for members, group_seeds in zip(groups, seeds):
+        # Number the sub-groups in the order their seeds appear
+        is_seed = group_seeds == np.arange(len(members))
+        sub_groups[members] = sub_group_id - 1 + np.cumsum(is_seed)[group_seeds]
+        sub_group_id += int(is_seed.sum())
     
     return sub_groups
 
+# Columns the grouping, sub-grouping and export filters read from an occurrence file
+GROUPING_COLUMNS = ['locality', 'habitat', 'eventDate', 'recordNumber', 'collectionCode', 'decimalLatitude', 'decimalLongitude']
+
+# Record identifiers written to the group sidecar next to the row position, when the file has them
+SIDECAR_KEY_COLUMNS = ['id', 'catalogNumber']
+
+# Group assignments, locality features and group counts written to the group sidecar
+SIDECAR_COLUMNS = ['Group_ID', 'Sub_Group_ID', 'compassDirection', 'distance', 'distanceUnit',
+                   'decimalLatitude_count', 'decimalLongitude_count', 'allowed_collection_count']
+
+# Columns of the file that the pipeline rewrites in place (recordNumber is made numeric)
+REWRITTEN_COLUMNS = ['recordNumber']
+
+# Function to load an occurrence file with the Darwin Core dtypes. "full" reads every column;
+# "projected" only reads the columns grouping needs (plus extra blocking key columns), and the
+# full columns of the rows that are kept are read again at export time by join_full_columns.
+def load_occurrences(csv_file, load_mode='full', extra_columns=()):
+    if load_mode == 'full':
+        return read_occurrences(csv_file, required=GROUPING_COLUMNS)
+    elif load_mode == 'projected':
+        usecols = GROUPING_COLUMNS + SIDECAR_KEY_COLUMNS + list(extra_columns)
+        return read_occurrences(csv_file, required=GROUPING_COLUMNS, usecols=usecols)
+    raise ValueError(f"Unknown load mode '{load_mode}' in export_config.txt.")
+
+# Function to read every column of the rows at the given positions with a chunked pass over
+# the file, so only the kept rows are ever held with all of their columns
+def read_rows_by_position(csv_file, positions, chunk_size=500000):
+    positions = np.sort(np.asarray(positions, dtype=np.int64))
+    parts = []
+    start = 0
+    for chunk in read_occurrences(csv_file, chunksize=chunk_size):
+        stop = start + len(chunk)
+        first, last = np.searchsorted(positions, [start, stop])
+        if last > first:
+            parts.append(chunk.iloc[positions[first:last] - start])
+        start = stop
+    return pd.concat(parts)
+
+# Function to swap the rows of a projected frame for their full rows from the file. Columns
+# the pipeline added (features, group IDs) or rewrote are carried over from the frame.
+def join_full_columns(csv_file, df):
+    full = read_rows_by_position(csv_file, df.index.to_numpy()).loc[df.index]
+    for column in df.columns:
+        if column not in full.columns or column in REWRITTEN_COLUMNS:
+            full[column] = df[column]
+    return full
+
+# Function to name the outputs of a county read from a state file: data.csv -> data_Travis.csv
+def county_output_file(csv_file, county):
+    county = re.sub(r'[<>:"/\\|?*]', '-', county.strip())
+    return os.path.splitext(csv_file)[0] + f"_{county}.csv"
+
+# Function to save the group sidecar: a parquet file mapping every exported record (its row
+# position in the source file, id and catalogNumber) to its group, sub-group, locality features
+# and group counts, in the same order as -groups.csv. Returns the sidecar filename.
+def save_group_sidecar(input_filename, filtered_df):
+    keys = [column for column in SIDECAR_KEY_COLUMNS if column in filtered_df.columns]
+    sidecar = filtered_df[keys + SIDECAR_COLUMNS].rename_axis('row').reset_index()
+    sidecar_filename = input_filename.replace('.csv', '-groups.parquet')
+    sidecar.to_parquet(sidecar_filename, index=False)
+    return sidecar_filename
+
+# Function to reattach a group sidecar to its source file: reads every column of the records
+# the sidecar lists (one chunked pass) and adds the sidecar columns, in sidecar order
+def join_group_sidecar(csv_file, sidecar_filename=None, county=None):
+    output_file = county_output_file(csv_file, county) if county else csv_file
+    sidecar = pd.read_parquet(sidecar_filename or output_file.replace('.csv', '-groups.parquet')).set_index('row')
+    if county:
+        # Rows of a county run are positions among the county's records
+        records = read_county_rows(csv_file, county).loc[sidecar.index]
+    else:
+        records = read_rows_by_position(csv_file, sidecar.index.to_numpy()).loc[sidecar.index]
+    for column in SIDECAR_COLUMNS:
+        records[column] = sidecar[column]
+    return records
+
 # Function to load the export configuration file from the script's location
 def load_export_config():
     script_dir = os.path.dirname(os.path.realpath(__file__))  # Get the location of the Python script
@@ -252,12 +883,6 @@ def load_export_config():
         print(f"Configuration file not found at {config_filename}.")
         return None, None
 
-# Function to filter groups based on allowed collection codes
-def filter_by_collection_code(df, allowed_collections):
-    allowed_collections = [coll.strip() for coll in allowed_collections.split(',')]
-    filtered_df = df.groupby('Group_ID').filter(lambda group: any(group['collectionCode'].isin(allowed_collections)))
-    return filtered_df
-
 # Function to prompt user for folder selection and load all CSV files
 def load_csv_files_from_folder(folder_path=None):
     if not folder_path:    
@@ -275,36 +900,66 @@ def load_csv_files_from_folder(folder_path=None):
         print("No folder selected.")
         return None, None
 
-# Function to check if all latitudes and longitudes in a group are identical
-def has_identical_coords(group):
-    """Check if all records in the group have identical latitude and longitude."""
-    return (group['decimalLatitude'].nunique() == 1) and (group['decimalLongitude'].nunique() == 1)
-
-# Function to count allowed collections in each group
-def count_allowed_collections(df, allowed_collections):
-    """Count the number of records in each group that have collectionCode in the allowed list."""
+# Function to compute the export stats of every group in one grouped pass: how many records
+# come from an allowed collection and how many distinct latitudes and longitudes it has.
+# Returns the per-record allowed flags and the per-group stats (indexed by Group_ID).
+def group_export_stats(df, allowed_collections):
     allowed_collections = [coll.strip() for coll in allowed_collections.split(',')]
-    # Create a new column that checks if the collectionCode is in the allowed_collections list
-    df['is_allowed_collection'] = df['collectionCode'].apply(lambda x: x in allowed_collections)
-    
-    # Group by 'Group_ID' and count the allowed collectionCode matches
-    group_counts = df.groupby('Group_ID')['is_allowed_collection'].sum().reset_index()
-    group_counts.rename(columns={'is_allowed_collection': 'allowed_collection_count'}, inplace=True)
-    
-    return group_counts
-
-
-# Function to count decimalLatitude and decimalLongitude values in each group
-def count_coords(df):
-    """Count the number of unique decimalLatitude and decimalLongitude values in each group."""
-    coord_counts = df.groupby('Group_ID').agg(
+    is_allowed_collection = df['collectionCode'].isin(allowed_collections)
+    stats = pd.DataFrame({
+        'Group_ID': df['Group_ID'],
+        'is_allowed_collection': is_allowed_collection,
+        'decimalLatitude': df['decimalLatitude'],
+        'decimalLongitude': df['decimalLongitude']
+    }).groupby('Group_ID').agg(
+        allowed_collection_count=('is_allowed_collection', 'sum'),
         decimalLatitude_count=('decimalLatitude', 'nunique'),
         decimalLongitude_count=('decimalLongitude', 'nunique')
-    ).reset_index()
-    return coord_counts
+    )
+    return is_allowed_collection, stats
+
+# Record separator added to the line end while serializing. Fields are quoted when they hold a
+# character of the line terminator, so keeping the usual line end in it quotes every field
+# exactly like a plain to_csv, and the separator still marks where each row ends.
+ROW_SEPARATOR = '\x1e'
+
+# Function to write a sorted frame to several CSV files in one pass. sinks maps each output
+# filename to a boolean mask of the rows it gets. Every chunk of rows is serialized once and
+# its lines are routed to each sink; a file is only created once it gets a row. Returns the
+# filenames that were written.
+def write_csv_sinks(df, sinks, chunk_size=100000):
+    terminator = os.linesep + ROW_SEPARATOR
+    header = df.iloc[:0].to_csv(index=False)
+    files = {}
+    try:
+        for start in range(0, len(df), chunk_size):
+            chunk = df.iloc[start:start + chunk_size]
+            text = chunk.to_csv(index=False, header=False, lineterminator=terminator)
+            if text.count(ROW_SEPARATOR) == len(chunk):
+                lines = [row + os.linesep for row in text.split(terminator)[:-1]]
+            else:
+                lines = None  # A field holds the separator, so write this chunk per sink instead
+
+            for filename, mask in sinks.items():
+                rows = np.flatnonzero(np.asarray(mask[start:start + chunk_size]))
+                if not len(rows):
+                    continue
+                if filename not in files:
+                    files[filename] = open(filename, 'w', encoding='utf-8', newline='')
+                    files[filename].write(header)
+                if lines is None:
+                    files[filename].write(chunk.iloc[rows].to_csv(index=False, header=False))
+                else:
+                    files[filename].write(''.join(lines[row] for row in rows))
+    finally:
+        for file in files.values():
+            file.close()
+    return list(files)
 
 # Modify the save_filtered_groups_to_csv function to include compassDirection, distance, and coordinate counts
-def save_filtered_groups_to_csv(input_filename, df, group_assignments, sub_group_assignments, min_size, export_columns, allowed_collections):
+def save_filtered_groups_to_csv(input_filename, df, group_assignments, sub_group_assignments, min_size, export_columns, allowed_collections, load_mode='full', all_columns=False, output='full'):
+    if output not in ('full', 'sidecar', 'both'):
+        raise ValueError(f"Unknown output: {output}")
     df['Group_ID'] = group_assignments  # Add the group ID to the DataFrame
     df['Sub_Group_ID'] = sub_group_assignments  # Add the sub-group ID to the DataFrame
     
@@ -321,62 +976,70 @@ def save_filtered_groups_to_csv(input_filename, df, group_assignments, sub_group
         export_columns.append('decimalLongitude_count')
     
     # Filter to only include groups that have more than the specified number of records
-    group_counts = df['Group_ID'].value_counts()
-    large_groups = group_counts[group_counts > min_size].index
+    large_groups = df.groupby('Group_ID')['Group_ID'].transform('size') > min_size
     
     # Exclude records with blank or null localities and identical decimalLatitude and decimalLongitude
     filtered_df = df[
-        df['Group_ID'].isin(large_groups) & 
+        large_groups & 
         df['locality'].notnull() & df['locality'].str.strip().ne('')
     ]
     
-    # Filter out groups where all latitudes and longitudes are identical
-    filtered_df = filtered_df.groupby('Group_ID').filter(lambda x: not has_identical_coords(x))
-    
-    # Filter by allowed collectionCode
-    filtered_df = filter_by_collection_code(filtered_df, allowed_collections)
+    # Per-group stats in one pass: keep groups whose coordinates aren't all identical and
+    # that have at least one record from an allowed collection
+    is_allowed_collection, group_stats = group_export_stats(filtered_df, allowed_collections)
+    identical_coords = (group_stats['decimalLatitude_count'] == 1) & (group_stats['decimalLongitude_count'] == 1)
+    kept_groups = group_stats.index[~identical_coords & (group_stats['allowed_collection_count'] > 0)]
+    filtered_df = filtered_df[filtered_df['Group_ID'].isin(kept_groups)]
     
     if not filtered_df.empty:
-        # Count the number of allowed collections in each group
-        allowed_collection_counts = count_allowed_collections(filtered_df, allowed_collections)
-        
-        # Count the number of unique decimalLatitude and decimalLongitude values in each group
-        coord_counts = count_coords(filtered_df)
-        
-        # Merge the counts back to the filtered DataFrame
-        filtered_df = filtered_df.merge(allowed_collection_counts, on='Group_ID', how='left')
-        filtered_df = filtered_df.merge(coord_counts, on='Group_ID', how='left')
-        
-        # Reorder columns based on the configuration
-        #TODO - make an arg over-ride for this
-        #if export_columns:
-        #    filtered_df = filtered_df[export_columns + ['allowed_collection_count']]
+        # A projected load only holds the grouping columns, so fetch the rest for the kept rows
+        # (the sidecar alone doesn't need them)
+        if load_mode == 'projected' and output != 'sidecar':
+            filtered_df = join_full_columns(input_filename, filtered_df)
+
+        # Join the allowed collection flags and the group counts to the records
+        filtered_df = filtered_df.assign(is_allowed_collection=is_allowed_collection).join(group_stats, on='Group_ID')
         
         # Sort by allowed collection count, then by Group_ID, Sub_Group_ID, and eventDate
         if 'eventDate' in filtered_df.columns:
             filtered_df.sort_values(by=['allowed_collection_count', 'Group_ID', 'Sub_Group_ID', 'eventDate'], ascending=[False, True, True, True], inplace=True)
         else:
             filtered_df.sort_values(by=['allowed_collection_count', 'Group_ID', 'Sub_Group_ID'], ascending=[False, True, True], inplace=True)
+
+        # Groups with 0 decimalLatitude_count and 0 decimalLongitude_count go to -CoGe.csv, the
+        # rest (1 or more of either) to -manual.csv; every group also goes to -groups.csv
+        coge_rows = ((filtered_df['decimalLatitude_count'] == 0) & (filtered_df['decimalLongitude_count'] == 0)).to_numpy()
+
+        # Save the record to group mapping, which join_group_sidecar can reattach to the source
+        if output in ('sidecar', 'both'):
+            sidecar_filename = save_group_sidecar(input_filename, filtered_df)
+            print(f"Group sidecar saved to {sidecar_filename}")
+            if output == 'sidecar':
+                return
+
+        # Keep only the configured export columns, unless all columns were asked for
+        if not all_columns:
+            columns = list(dict.fromkeys(export_columns + ['allowed_collection_count']))
+            missing = [column for column in columns if column not in filtered_df.columns]
+            if missing:
+                print(f"Export columns not in {input_filename}: {', '.join(missing)}")
+            filtered_df = filtered_df[[column for column in columns if column in filtered_df.columns]]
         
-        # Automatically create the output filename by appending "-groups.csv"
+        # Automatically create the output filenames by appending "-groups.csv", "-CoGe.csv" and "-manual.csv"
         output_filename = input_filename.replace('.csv', '-groups.csv')
+        coge_filename = input_filename.replace('.csv', '-CoGe.csv')
+        manual_filename = input_filename.replace('.csv', '-manual.csv')
         
-        # Save the filtered DataFrame to the output file
-        filtered_df.to_csv(output_filename, index=False)
+        # Serialize the sorted rows once and route them to every file they belong to
+        written = write_csv_sinks(filtered_df, {
+            output_filename: np.ones(len(filtered_df), dtype=bool),
+            coge_filename: coge_rows,
+            manual_filename: ~coge_rows
+        })
         print(f"Group data saved to {output_filename}")
-
-        # Save groups with 0 decimalLatitude_count and 0 decimalLongitude_count to an additional file
-        coge_groups = filtered_df[(filtered_df['decimalLatitude_count'] == 0) & (filtered_df['decimalLongitude_count'] == 0)]
-        if not coge_groups.empty:
-            coge_filename = input_filename.replace('.csv', '-CoGe.csv')
-            coge_groups.to_csv(coge_filename, index=False)
+        if coge_filename in written:
             print(f"Groups with 0 decimalLatitude_count and 0 decimalLongitude_count saved to {coge_filename}")
-
-        # Save groups with 1 or more decimalLatitude_count or decimalLongitude_count to an additional file
-        manual_groups = filtered_df[(filtered_df['decimalLatitude_count'] > 0) | (filtered_df['decimalLongitude_count'] > 0)]
-        if not manual_groups.empty:
-            manual_filename = input_filename.replace('.csv', '-manual.csv')
-            manual_groups.to_csv(manual_filename, index=False)
+        if manual_filename in written:
             print(f"Groups with 1 or more decimalLatitude_count or decimalLongitude_count saved to {manual_filename}")
     else:
         print(f"No groups found with more than {min_size} records and non-blank localities.")
@@ -389,24 +1052,74 @@ def process_csv(csv_file=None,
     habitat_similarity_threshold=None,
     similarity_threshold=None,
     min_size=None,
-    allowed_collections=None):
+    allowed_collections=None,
+    all_columns=False,
+    output='full',
+    county=None):
+
+    print(f"Processing file: {csv_file}" + (f" (county {county})" if county else ""))
+
+    # Extra blocking keys, e.g. "blocking_keys=county,locality_token"
+    blocking_keys = [key.strip() for key in config.get('blocking_keys', '').split(',') if key.strip()]
+
+    # Load the CSV file: every column ("full") or only the grouping columns ("projected")
+    load_mode = config.get('load_mode', 'full')
+    if county:
+        # One county's records, sliced out of the file through its county index; the outputs
+        # are named after the county. The county is loaded in full, so it is never projected.
+        if load_mode == 'projected':
+            print("Using load_mode=full for a county read through the county index")
+        load_mode = 'full'
+        df = read_county_rows(csv_file, county, required=GROUPING_COLUMNS)
+        output_file = county_output_file(csv_file, county)
+    else:
+        df = load_occurrences(csv_file, load_mode, extra_columns=blocking_keys)
+        output_file = csv_file
+
+    # Parse compass direction, distance and the normalized locality once for every record
+    extract_locality_features(df)
 
-    print(f"Processing file: {csv_file}")
+    # Threads used by the batched fuzzy scorer, e.g. "scoring_workers=4" (-1 uses every core)
+    workers = int(config.get('scoring_workers', 1))
 
-    # Load the CSV file
-    df = pd.read_csv(csv_file, encoding='ISO-8859-1', low_memory=False)
+    # Processes that share the pair scoring and sub-grouping of this file, e.g. "scoring_processes=8"
+    processes = int(config.get('scoring_processes', 1))
+
+    # Locality similarity: "fuzzy" (token sort ratio) or "cosine" (TF-IDF over the whole file)
+    method = config.get('similarity_method', 'fuzzy')
+    cosine_analyzer = config.get('cosine_analyzer', 'char_wb')
+    cosine_ngram_range = tuple(int(n) for n in config.get('cosine_ngram_range', '3,3').split(','))
+
+    # Candidate pairs: "blocks" (every pair in a block) or "lsh" (approximate MinHash LSH)
+    candidate_pairs = config.get('candidate_pairs', 'blocks')
+    lsh_num_perm = int(config.get('lsh_num_perm', 128))
+    lsh_bands = int(config.get('lsh_bands', 0))
+    lsh_rows = int(config.get('lsh_rows', 0))
+    lsh_jaccard = float(config.get('lsh_jaccard', 0.7))
+    lsh_recall = float(config.get('lsh_recall', 0.95))
+
+    # Grouping: "greedy" (each record joins the first seed it matches) or "connected" (chains of matches)
+    grouping_mode = config.get('grouping_mode', 'greedy')
 
     # Find duplicate groups based on the user-defined similarity threshold
-    groups, group_assignments = find_potential_duplicates(df, similarity_threshold, method='fuzzy')
+    groups, group_assignments = find_potential_duplicates(df, similarity_threshold, method=method, blocking_keys=blocking_keys,
+                                                          workers=workers, processes=processes, grouping_mode=grouping_mode,
+                                                          cosine_analyzer=cosine_analyzer, cosine_ngram_range=cosine_ngram_range,
+                                                          candidate_pairs=candidate_pairs, lsh_num_perm=lsh_num_perm, lsh_bands=lsh_bands,
+                                                          lsh_rows=lsh_rows, lsh_jaccard=lsh_jaccard, lsh_recall=lsh_recall)
 
     # Assign the 'Group_ID' column to the DataFrame before creating sub-groups
     df['Group_ID'] = group_assignments
 
     # Assign sub-groups based on eventDate, recordNumber, and habitat similarity
-    sub_group_assignments = assign_sub_groups(df, eventdate_tolerance=eventdate_tolerance, recordnumber_tolerance=recordnumber_tolerance, habitat_similarity_threshold=habitat_similarity_threshold)
+    sub_group_assignments = assign_sub_groups(df, eventdate_tolerance=eventdate_tolerance, recordnumber_tolerance=recordnumber_tolerance, habitat_similarity_threshold=habitat_similarity_threshold, workers=workers, processes=processes)
+
+    # The normalized locality is only a working column for the scorer
+    df.drop(columns=['normalizedLocality'], inplace=True)
 
     # Save the filtered groups to the CSV, using the input filename to create the output filename
-    save_filtered_groups_to_csv(csv_file, df, group_assignments, sub_group_assignments, min_size, export_columns, allowed_collections)
+    save_filtered_groups_to_csv(output_file, df, group_assignments, sub_group_assignments, min_size, export_columns, allowed_collections,
+                                load_mode=load_mode, all_columns=all_columns, output=output)
 
 # Main function
 def main():
@@ -446,7 +1159,9 @@ def main():
                     habitat_similarity_threshold=habitat_similarity_threshold,
                     similarity_threshold=similarity_threshold,
                     min_size=min_size,
-                    allowed_collections=allowed_collections)
+                    allowed_collections=allowed_collections,
+                    all_columns=args['all_columns'],
+                    output=args['output'])
                 """
                 print(f"Processing file: {csv_file}")
                 
@@ -473,80 +1188,142 @@ def main():
 
 
 
-def process_multiple_csv_files(csv_files, num_threads=4):
-
-    # Load the configuration and fields from export_config.txt
-    config, export_columns = load_export_config()
-    
-    if config is None or export_columns is None:
-        return
+# Function to order CSV files by estimated cost, largest first. Pair scoring grows with the
+# square of the row count, so one big county started last would set the wall-clock time. The
+# file size stands in for the row count, so no file is read before the work starts.
+def order_csv_files_by_cost(csv_files):
+    costs = {csv_file: os.path.getsize(csv_file) ** 2 for csv_file in csv_files}
+    return sorted(csv_files, key=lambda csv_file: costs[csv_file], reverse=True)
 
+# Function to order (csv_file, county) tasks by estimated cost, largest first, the same way.
+# The row count of every county comes from its file's county index; tasks of a file whose index
+# can't be loaded are left at the end, where they report the error.
+def order_county_tasks_by_cost(csv_files, counties):
+    costs = {}
+    for csv_file in csv_files:
+        try:
+            rows = county_row_counts(csv_file, counties)
+        except (ValueError, OSError):
+            rows = {}
+        for county in counties:
+            costs[(csv_file, county)] = rows.get(county, 0) ** 2
+    tasks = [(csv_file, county) for csv_file in csv_files for county in counties]
+    return sorted(tasks, key=lambda task: costs[task], reverse=True)
 
-    # Read tolerances and thresholds from the configuration file
-    eventdate_tolerance = int(config.get('eventdate_tolerance', 3))
-    recordnumber_tolerance = int(config.get('recordnumber_tolerance', 5))
-    habitat_similarity_threshold = int(config.get('habitat_similarity_threshold', 80))
-    similarity_threshold = int(config.get('similarity_threshold', 80))
-    min_size = int(config.get('min_size', 0))
-    allowed_collections = config.get('allowed_collections', '')  # Fetch allowed collections
+# Function to process one CSV file (or one county of it) in a worker. Errors are returned instead
+# of raised so one bad file doesn't stop the batch: returns (name, None) or (name, error text).
+def process_csv_job(csv_file, config, export_columns, settings, county=None):
+    name = job_name(csv_file, county)
+    try:
+        process_csv(csv_file=csv_file, config=config, export_columns=export_columns, county=county, **settings)
+        return name, None
+    except Exception:
+        return name, traceback.format_exc()
 
+# Function to name a job in progress and error messages
+def job_name(csv_file, county=None):
+    return f"{csv_file} (county {county})" if county else csv_file
 
+# Function to process one CSV file in a process of its own, so a worker that dies (e.g. killed
+# for running out of memory) only fails its own file
+def process_csv_job_isolated(csv_file, config, export_columns, settings, county=None):
+    with ProcessPoolExecutor(max_workers=1) as pool:
+        try:
+            return pool.submit(process_csv_job, csv_file, config, export_columns, settings, county).result()
+        except BrokenProcessPool:
+            return job_name(csv_file, county), traceback.format_exc()
 
+def process_multiple_csv_files(csv_files, jobs=4, executor='process', all_columns=False, output='full', counties=None):
     """
-    Process multiple CSV files in parallel using threading.
-    
+    Process multiple CSV files (or counties of them) in parallel, largest first.
+
     Args:
         csv_files (list): List of CSV file paths to process
-        num_threads (int): Number of threads to use
+        jobs (int): Number of files processed at the same time
+        executor (str): 'process' (process pool), 'thread' (thread pool) or 'serial'
+        all_columns (bool): Export every column instead of the configured fields
+        output (str): 'full' (CSV exports), 'sidecar' (group sidecar only) or 'both'
+        counties (list): Process only these counties of each file, through its county index
+
+    Returns:
+        list: (csv_file, error text) for every file that failed
     """
-    # Create a queue to hold the files
-    file_queue = queue.Queue()
-    
-    # Put all files in the queue
-    for file in csv_files:
-        file_queue.put(file)
-    
-    # Define the worker function
-    def worker():
-        while not file_queue.empty():
-            try:
-                # Get a file from the queue
-                file = file_queue.get(block=False)
-                print(f"Processing {file} in thread {threading.current_thread().name}")
-                
-                # Process the file using your existing function
-                #process_csv(file)
-                process_csv(csv_file=file,
-                    config=config,
-                    export_columns=export_columns,
-                    eventdate_tolerance=eventdate_tolerance, 
-                    recordnumber_tolerance=recordnumber_tolerance, 
-                    habitat_similarity_threshold=habitat_similarity_threshold,
-                    similarity_threshold=similarity_threshold,
-                    min_size=min_size,
-                    allowed_collections=allowed_collections)
-                
-                # Mark the task as done
-                file_queue.task_done()
-            except queue.Empty:
-                break
-            except Exception as e:
-                print(f"Error processing {file}: {e}")
-                file_queue.task_done()
-    
-    # Create and start the threads
-    threads = []
-    for i in range(min(num_threads, len(csv_files))):
-        thread = threading.Thread(target=worker, name=f"Thread-{i+1}")
-        thread.daemon = True
-        thread.start()
-        threads.append(thread)
-    
-    # Wait for all threads to complete
-    for thread in threads:
-        thread.join()
+    # Load the configuration and fields from export_config.txt
+    config, export_columns = load_export_config()
     
-    print("All files have been processed!")
+    if config is None or export_columns is None:
+        return []
+
+    # Read tolerances and thresholds from the configuration file
+    settings = {
+        'eventdate_tolerance': int(config.get('eventdate_tolerance', 3)),
+        'recordnumber_tolerance': int(config.get('recordnumber_tolerance', 5)),
+        'habitat_similarity_threshold': int(config.get('habitat_similarity_threshold', 80)),
+        'similarity_threshold': int(config.get('similarity_threshold', 80)),
+        'min_size': int(config.get('min_size', 0)),
+        'allowed_collections': config.get('allowed_collections', ''),  # Fetch allowed collections
+        'all_columns': all_columns,
+        'output': output
+    }
+
+    if executor not in ('process', 'thread', 'serial'):
+        raise ValueError(f"Unknown executor: {executor}")
+    # One task per file, or per county of each file when counties are given
+    if counties:
+        tasks = order_county_tasks_by_cost(csv_files, counties)
+    else:
+        tasks = [(csv_file, None) for csv_file in order_csv_files_by_cost(csv_files)]
+    jobs = max(1, min(jobs, len(tasks)))
+    if executor == 'process' and jobs > 1 and int(config.get('scoring_processes', 1)) > 1:
+        # The file pool already uses the cores, so each file scores in its own process
+        print("Using scoring_processes=1 while files run in a process pool")
+        config = dict(config, scoring_processes='1')
+
+    failures = []
+    if executor == 'serial' or jobs == 1:
+        results = (process_csv_job(csv_file, config, export_columns, settings, county) for csv_file, county in tasks)
+        for csv_file, error in results:
+            if error:
+                print(f"Error processing {csv_file}:\n{error}")
+                failures.append((csv_file, error))
+    else:
+        pool_class = ProcessPoolExecutor if executor == 'process' else ThreadPoolExecutor
+        broken = []
+        with pool_class(max_workers=jobs) as pool:
+            # Workers pick up the next largest file as soon as they finish one
+            futures = {pool.submit(process_csv_job, csv_file, config, export_columns, settings, county): (csv_file, county)
+                       for csv_file, county in tasks}
+            for future in as_completed(futures):
+                try:
+                    csv_file, error = future.result()
+                except BrokenProcessPool:
+                    # A worker died and took the pool down; this file didn't finish
+                    broken.append(futures[future])
+                    continue
+                except Exception:
+                    csv_file, error = job_name(*futures[future]), traceback.format_exc()
+                if error:
+                    print(f"Error processing {csv_file}:\n{error}")
+                    failures.append((csv_file, error))
+
+        if broken:
+            # Run the unfinished files again, each in its own process, so whichever file kills
+            # its worker fails alone
+            print(f"A worker process died; retrying {len(broken)} unfinished files one process each")
+            with ThreadPoolExecutor(max_workers=jobs) as pool:
+                results = pool.map(lambda task: process_csv_job_isolated(task[0], config, export_columns, settings, task[1]), broken)
+                for csv_file, error in results:
+                    if error:
+                        print(f"Error processing {csv_file}:\n{error}")
+                        failures.append((csv_file, error))
+
+    if failures:
+        print(f"{len(tasks) - len(failures)} of {len(tasks)} files processed. Failed files:")
+        for csv_file, error in failures:
+            print(f"  {csv_file}")
+    else:
+        print("All files have been processed!")
+    return failures
 
 def main_multi():   
     # Measure the execution time
@@ -562,7 +1339,10 @@ def main_multi():
     args = arg_setup()
     print(args['input'])
     input_path = args['input']
-    if input_path: 
+    if input_path and os.path.isfile(input_path):
+        # A single file, e.g. a state file read county by county through its county index
+        csv_files = [input_path]
+    elif input_path: 
         csv_files, folder_path = load_csv_files_from_folder(folder_path=input_path)
     else:
         # Load CSV files from the selected folder
@@ -570,15 +1350,17 @@ def main_multi():
     #print(csv_files, folder_path)
     
 
-    available_cores = mp.cpu_count()
-    num_threads = max(1, available_cores - 1)
-    process_multiple_csv_files(csv_files, num_threads=num_threads)
+    if csv_files:
+        process_multiple_csv_files(csv_files, jobs=args['jobs'], executor=args['executor'], all_columns=args['all_columns'], output=args['output'],
+                                   counties=args['county'])
+    else:
+        print("No valid CSV files to process.")
     elapsed_time = time.time() - start_time
     print(f"Execution completed in {elapsed_time:.2f} seconds")
 
 
 if __name__ == "__main__":
     # Ensure multiprocessing works correctly on all platforms
-    #mp.freeze_support()
+    mp.freeze_support()
     #main()
     main_multi()
@@ -1,9 +1,10 @@
-import pandas as pd
+from dwc_schema import read_occurrences
 
 def count_null_collectioncode(csv_file):
     try:
-        # Try reading the CSV file with different encoding options
-        df = pd.read_csv(csv_file, dtype=str, encoding='latin1')  # Use 'latin1' to handle unusual characters
+        # Only the two code columns are needed; missing ones raise a ValueError before parsing
+        df = read_occurrences(csv_file, required=['collectionCode', 'institutionCode'],
+                              usecols=['collectionCode', 'institutionCode'], encoding='latin1')  # Use 'latin1' to handle unusual characters
 
         # Identify records with empty or null collectionCode
         missing_collectioncode = df['collectionCode'].isna() | (df['collectionCode'] == '')
@@ -12,7 +13,7 @@ def count_null_collectioncode(csv_file):
         null_count = missing_collectioncode.sum()
 
         # Count how many of these have a valid institutionCode
-        substitute_counts = df.loc[missing_collectioncode, 'institutionCode'].value_counts()
+        substitute_counts = df.loc[missing_collectioncode, 'institutionCode'].astype(object).value_counts()
 
         print(f"Number of records with null or empty 'collectionCode': {null_count}")
         print("Substituting with 'institutionCode' counts:")
@@ -2,6 +2,7 @@ import os
 import pandas as pd
 import tkinter as tk
 from tkinter import filedialog
+from dwc_schema import read_occurrences
 
 def get_folder():
     root = tk.Tk()
@@ -16,7 +17,7 @@ def combine_csvs(folder_path, suffix):
         print(f"No files found with suffix '{suffix}' in {folder_path}")
         return
     
-    combined_df = pd.concat([pd.read_csv(os.path.join(folder_path, f)) for f in all_files], ignore_index=True)
+    combined_df = pd.concat([read_occurrences(os.path.join(folder_path, f), encoding='utf-8') for f in all_files], ignore_index=True)
     output_file = os.path.join(folder_path, f"combined_{suffix}.csv")
     combined_df.to_csv(output_file, index=False)
     
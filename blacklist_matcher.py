@@ -0,0 +1,83 @@
+"""
+Georeference blacklists shared by the choppers and fishnet.
+
+Exact-match blacklists (georeferenceSources, georeferenceVerificationStatus) and
+phrase blacklists (georeferenceRemarks) are compiled once: the phrases of a column
+become a single case-insensitive regex of escaped literals, so a value is searched
+for every phrase in one pass. Each test runs over the distinct values of a column
+rather than every record, and the answers are mapped back to the records.
+
+Empty entries (e.g. a blank "georeferenceRemarksBlacklist:" line) are ignored.
+
+"""
+
+import os
+import re
+import numpy as np
+import pandas as pd
+
+# Chopper_Config.txt keys of the exact-match blacklists and the columns they apply to
+EXACT_BLACKLISTS = {
+    'georeferenceSourcesBlacklist': 'georeferenceSources',
+    'georeferenceVerificationStatusBlacklist': 'georeferenceVerificationStatus'
+}
+
+# Chopper_Config.txt keys of the phrase (case-insensitive substring) blacklists
+PHRASE_BLACKLISTS = {
+    'georeferenceRemarksBlacklist': 'georeferenceRemarks'
+}
+
+# Function to compile blacklist phrases into one case-insensitive regex of literals, or None
+# when there are no phrases. Longer phrases go first so overlapping ones match the same way.
+def compile_phrases(phrases):
+    phrases = sorted({phrase.strip() for phrase in phrases if phrase.strip()}, key=len, reverse=True)
+    if not phrases:
+        return None
+    return re.compile('|'.join(map(re.escape, phrases)), re.IGNORECASE)
+
+# Function to build the blacklist tests: exact and phrases map columns to listed values and
+# phrases. Returns {column: test} where test(value) is True for a blacklisted value.
+def compile_blacklists(exact=None, phrases=None):
+    tests = {}
+    for column, values in (exact or {}).items():
+        values = frozenset(value.strip() for value in values if value.strip())
+        if values:
+            tests[column] = values.__contains__
+    for column, column_phrases in (phrases or {}).items():
+        pattern = compile_phrases(column_phrases)
+        if pattern is not None:
+            tests[column] = lambda value, search=pattern.search: search(value) is not None
+    return tests
+
+# Function to read the georeference blacklists from Chopper_Config.txt (next to this script by
+# default) and compile them
+def load_blacklists(config_path=None):
+    config_path = config_path or os.path.join(os.path.dirname(os.path.realpath(__file__)), 'Chopper_Config.txt')
+    exact, phrases = {}, {}
+    with open(config_path, 'r') as file:
+        for line in file:
+            key, _, value = line.strip().partition(':')
+            if key in EXACT_BLACKLISTS:
+                exact.setdefault(EXACT_BLACKLISTS[key], set()).update(value.split(','))
+            elif key in PHRASE_BLACKLISTS:
+                phrases.setdefault(PHRASE_BLACKLISTS[key], set()).update(value.split(','))
+    return compile_blacklists(exact, phrases)
+
+# Function to apply a test to the distinct values of a column and map the answers back to its
+# records. Null values are never blacklisted.
+def unique_value_mask(series, test):
+    codes, uniques = pd.factorize(series)
+    hits = np.fromiter((test(str(value)) for value in uniques), dtype=bool, count=len(uniques))
+    return np.append(hits, False)[codes]
+
+# Function to find the blacklisted records of a frame: {column: boolean mask of the records
+# whose value in that column is blacklisted}. Columns the frame doesn't have are skipped.
+def blacklist_hits(df, blacklists):
+    return {column: unique_value_mask(df[column], test) for column, test in blacklists.items() if column in df.columns}
+
+# Function to combine the hits of every blacklist into one mask of blacklisted records
+def blacklisted_records(df, blacklists):
+    blacklisted = np.zeros(len(df), dtype=bool)
+    for hits in blacklist_hits(df, blacklists).values():
+        blacklisted |= hits
+    return blacklisted
@@ -0,0 +1,148 @@
+"""
+County index for state-sized occurrence files.
+
+Instead of writing every county out to its own CSV, build_county_index scans the
+state file once and saves, next to it, the byte range of every record with its
+normalized county and state. read_county_rows then reads one county by slicing
+those ranges straight out of the original file, so county reruns don't need a
+chopped copy of the data.
+
+The index stores the size and modification time of the file it was built from;
+reading through an index of a file that has changed raises a ValueError.
+
+"""
+
+import csv
+import io
+import mmap
+import os
+import numpy as np
+import pandas as pd
+from dwc_schema import read_header, check_required_columns, dwc_dtypes
+from parallel_reader import find_record_ranges, parse_records
+
+# Suffix of the index file saved next to the occurrence file
+INDEX_SUFFIX = '.county-index.npz'
+
+# Bytes of records scanned at a time while building the index
+INDEX_BLOCK_BYTES = 8 << 20
+
+# Function to get the default index path of an occurrence file
+def county_index_path(csv_file):
+    return os.path.splitext(str(csv_file))[0] + INDEX_SUFFIX
+
+# Function to find the start offsets of the records in a block of whole records (offsets are
+# relative to the block). A newline ends a record when the quotes before it are balanced.
+def block_record_starts(block):
+    data = np.frombuffer(block, dtype=np.uint8)
+    newlines = np.flatnonzero(data == ord('\n'))
+    quotes = np.flatnonzero(data == ord('"'))
+    ends = newlines[np.searchsorted(quotes, newlines) % 2 == 0] + 1
+    return np.concatenate(([0], ends[ends < len(data)]))
+
+# Function to get a field of a parsed row, '' when the row is too short to have it
+def row_field(row, column):
+    return row[column] if column < len(row) else ''
+
+# Function to build the county index of an occurrence file in one scan and save it. normalize
+# maps a raw county value to its normalized name. keep_collection, when given, is called with a
+# record's collectionCode and decides whether the record is indexed. Returns the index path.
+def build_county_index(csv_file, normalize, keep_collection=None, sep=',', encoding='utf-8', index_file=None):
+    header = read_header(csv_file, sep=sep, encoding=encoding)
+    required = ['stateProvince', 'county'] + (['collectionCode'] if keep_collection else [])
+    check_required_columns(header, required, csv_file)
+    county_column, state_column = header.index('county'), header.index('stateProvince')
+    collection_column = header.index('collectionCode') if keep_collection else None
+
+    counties, states = {}, {}
+    county_names = {}  # raw county value -> normalized county code
+    starts, stops, county_codes, state_codes = [], [], [], []
+    size = os.path.getsize(csv_file)
+    ranges = find_record_ranges(csv_file, max(1, size // INDEX_BLOCK_BYTES))
+    with open(csv_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for start, stop in ranges:
+            block = mm[start:stop]
+            record_starts = block_record_starts(block)
+            record_stops = np.append(record_starts[1:], len(block))
+            rows = csv.reader(io.StringIO(block.decode(encoding), newline=''), delimiter=sep)
+            records = 0
+            for record, row in enumerate(rows):
+                records += 1
+                if not row:
+                    continue  # Blank line
+                if keep_collection and not keep_collection(row_field(row, collection_column)):
+                    continue
+                county = row_field(row, county_column)
+                if county not in county_names:
+                    county_names[county] = counties.setdefault(normalize(county), len(counties))
+                state = row_field(row, state_column).strip()
+                starts.append(start + record_starts[record])
+                stops.append(start + record_stops[record])
+                county_codes.append(county_names[county])
+                state_codes.append(states.setdefault(state, len(states)))
+            if records != len(record_starts):
+                raise ValueError(f"Quotes in bytes {start}-{stop} of {csv_file} don't pair up as CSV quoting; "
+                                 "the file can't be indexed by byte offset")
+
+    index_file = index_file or county_index_path(csv_file)
+    stat = os.stat(csv_file)
+    # np.savez adds .npz to names without it, so write through a file handle to keep the name
+    with open(index_file, 'wb') as f:
+        np.savez(f, starts=np.array(starts, dtype=np.int64), stops=np.array(stops, dtype=np.int64),
+                 county_codes=np.array(county_codes, dtype=np.int32), state_codes=np.array(state_codes, dtype=np.int32),
+                 counties=np.array(list(counties), dtype=str), states=np.array(list(states), dtype=str),
+                 header=np.array(header, dtype=str), sep=sep, encoding=encoding,
+                 file_size=stat.st_size, file_mtime_ns=stat.st_mtime_ns)
+    return index_file
+
+# Function to load a county index, checking that the occurrence file hasn't changed since
+def load_county_index(csv_file, index_file=None):
+    index_file = index_file or county_index_path(csv_file)
+    if not os.path.exists(index_file):
+        raise ValueError(f"No county index for {csv_file}; build it with CountyChopper.py --index")
+    index = dict(np.load(index_file))
+    stat = os.stat(csv_file)
+    if stat.st_size != index['file_size'] or stat.st_mtime_ns != index['file_mtime_ns']:
+        raise ValueError(f"{csv_file} has changed since {index_file} was built; rebuild it with CountyChopper.py --index")
+    return index
+
+# Function to count the records of each of the given counties in the county index, matching
+# names case-insensitively as read_county_rows does. Counties not in the index count 0.
+def county_row_counts(csv_file, counties, index_file=None):
+    index = load_county_index(csv_file, index_file)
+    records = np.bincount(index['county_codes'], minlength=len(index['counties']))
+    totals = {}
+    for code, name in enumerate(index['counties']):
+        totals[name.lower()] = totals.get(name.lower(), 0) + int(records[code])
+    return {county: totals.get(county.strip().lower(), 0) for county in counties}
+
+# Function to read the records of one county (and optionally one state) through the county
+# index, with the registry dtypes. Names match case-insensitively; the rows keep file order.
+def read_county_rows(csv_file, county, state=None, required=(), usecols=None, index_file=None, **read_csv_args):
+    index = load_county_index(csv_file, index_file)
+    header = list(index['header'])
+    check_required_columns(header, required, csv_file)
+
+    counties = [code for code, name in enumerate(index['counties']) if name.lower() == county.strip().lower()]
+    if not counties:
+        raise ValueError(f"County '{county}' is not in the county index of {csv_file}")
+    selected = np.isin(index['county_codes'], counties)
+    if state is not None:
+        states = [code for code, name in enumerate(index['states']) if name.lower() == state.strip().lower()]
+        selected &= np.isin(index['state_codes'], states)
+    starts, stops = index['starts'][selected], index['stops'][selected]
+    if usecols is not None:
+        usecols = [column for column in header if column in set(usecols)]
+    dtype = dwc_dtypes(usecols if usecols is not None else header)
+    if not len(starts):
+        return pd.DataFrame(columns=usecols if usecols is not None else header).astype(dtype)
+
+    # Records that follow each other in the file are sliced out as one run
+    run_starts = np.flatnonzero(np.r_[True, starts[1:] != stops[:-1]])
+    run_stops = np.r_[run_starts[1:], len(starts)] - 1
+    with open(csv_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        data = b''.join(mm[starts[first]:stops[last]] for first, last in zip(run_starts, run_stops))
+
+    read_csv_args.setdefault('low_memory', False)
+    return parse_records(data, header, str(index['sep']), str(index['encoding']), usecols, dtype, read_csv_args,
+                         f"county {county} of {csv_file}")
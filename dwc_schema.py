@@ -0,0 +1,189 @@
+"""
+Darwin Core field registry shared by every tool that loads occurrence files.
+
+read_occurrences reads a CSV/TSV with explicit dtypes for the common DwC fields
+instead of letting pandas guess them column by column: repeated codes and place
+names are categoricals, coordinates are floats and free text is kept as text.
+Required columns are checked against the header before the file is parsed, so a
+wrong file fails straight away. When every column has a fixed dtype, the file is
+parsed with pyarrow's multithreaded CSV reader, which is faster than pandas' own
+parser; anything pyarrow can't read the same way is read with pandas instead.
+
+"""
+
+import pandas as pd
+import pyarrow as pa
+from pyarrow import csv as pa_csv
+
+# Free text stays as Python strings. Fixing it as text keeps pandas from turning fields like
+# recordNumber into numbers; converting it to Arrow strings cost more parse time than it saved.
+TEXT_DTYPE = object
+
+# Short, heavily repeated codes and place names
+CATEGORY_FIELDS = [
+    'institutionCode',
+    'collectionCode',
+    'country',
+    'stateProvince',
+    'county',
+    'georeferenceVerificationStatus'
+]
+
+# Numeric fields. All float64: float32 keeps only ~7 significant digits and would round
+# coordinates and uncertainties (14142.1356 -> 14142.136) when the files are written back out.
+NUMERIC_FIELDS = {
+    'decimalLatitude': 'float64',
+    'decimalLongitude': 'float64',
+    'coordinateUncertaintyInMeters': 'float64'
+}
+
+# Free text
+TEXT_FIELDS = [
+    'catalogNumber',
+    'recordedBy',
+    'recordNumber',
+    'eventDate',
+    'habitat',
+    'locality',
+    'verbatimLocality',
+    'locationRemarks',
+    'verbatimCoordinates',
+    'georeferencedBy',
+    'georeferenceProtocol',
+    'georeferenceSources',
+    'georeferenceRemarks',
+    'occurrenceRemarks'
+]
+
+DWC_DTYPES = {
+    **{field: 'category' for field in CATEGORY_FIELDS},
+    **NUMERIC_FIELDS,
+    **{field: TEXT_DTYPE for field in TEXT_FIELDS}
+}
+
+# Function to get the registry dtypes of the given columns. Unknown columns get default_dtype,
+# or are left to pandas when it is None; overrides replace the dtype of the columns they name.
+def dwc_dtypes(columns, default_dtype=None, overrides=None):
+    if default_dtype is not None:
+        dtypes = {column: DWC_DTYPES.get(column, default_dtype) for column in columns}
+    else:
+        dtypes = {column: DWC_DTYPES[column] for column in columns if column in DWC_DTYPES}
+    dtypes.update({column: value for column, value in (overrides or {}).items() if column in columns})
+    return dtypes
+
+# Function to get the columns a dtype mapping reads as numbers, the ones the fallback re-reads
+def fixed_numeric_columns(dtype):
+    return [column for column, value in dtype.items() if NUMERIC_FIELDS.get(column) == value]
+
+# Function to read the column names of a file without parsing any rows
+def read_header(file_path, sep=',', encoding='ISO-8859-1'):
+    return list(pd.read_csv(file_path, sep=sep, encoding=encoding, nrows=0).columns)
+
+# Function to raise a ValueError naming every required column the file is missing
+def check_required_columns(columns, required, file_path):
+    missing = [column for column in required if column not in columns]
+    if missing:
+        raise ValueError(f"{file_path} is missing required column(s): {', '.join(missing)}")
+
+# Function to read a file in chunks with the registry dtypes. If a numeric field holds values
+# that aren't numbers, the file is read again from the top with pandas inferring that field,
+# and the rows already handed out are skipped, so every row is yielded exactly once.
+def read_occurrence_chunks(file_path, usecols, sep, encoding, dtype, read_csv_args):
+    rows = 0
+    try:
+        for chunk in pd.read_csv(file_path, sep=sep, encoding=encoding, usecols=usecols, dtype=dtype, **read_csv_args):
+            rows += len(chunk)
+            yield chunk
+        return
+    except ValueError as e:
+        numeric = fixed_numeric_columns(dtype)
+        if not numeric:
+            raise
+        print(f"Warning: {e} in {file_path}; reading {', '.join(numeric)} without a fixed dtype")
+    dtype = {column: value for column, value in dtype.items() if column not in numeric}
+    for chunk in pd.read_csv(file_path, sep=sep, encoding=encoding, usecols=usecols, dtype=dtype, **read_csv_args):
+        if rows >= len(chunk):
+            rows -= len(chunk)
+            continue
+        yield chunk.iloc[rows:]
+        rows = 0
+
+# Strings read as nulls, the same list pandas uses by default
+NA_VALUES = ['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN', '<NA>',
+             'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null']
+
+# read_csv arguments the pyarrow reader handles the same way as pandas
+ARROW_READ_ARGS = {'low_memory', 'on_bad_lines'}
+
+# Function to get the pyarrow type of a dtype, or None when pyarrow can't read it the same way
+def arrow_type(dtype):
+    if isinstance(dtype, str) and dtype == 'category':
+        return pa.dictionary(pa.int32(), pa.string())
+    if isinstance(dtype, str) and dtype == 'float64':
+        return pa.float64()
+    if dtype is str or dtype is object:
+        return pa.string()
+    return None
+
+# Function to skip records with too many fields, as pandas does with on_bad_lines='skip'. Records
+# with too few fields are padded by pandas, so they stop the pyarrow read instead.
+def skip_long_record(row):
+    return 'skip' if row.actual_columns > row.expected_columns else 'error'
+
+# Function to parse a file with pyarrow when every column has a fixed dtype and the arguments
+# allow it. Returns None when the file has to be read with pandas instead, including when
+# pyarrow fails on it, so pandas reports the error or applies its fallback.
+def read_with_arrow(file_path, header, usecols, sep, encoding, dtype, read_csv_args):
+    columns = usecols if usecols is not None else header
+    types = {column: arrow_type(dtype.get(column)) for column in columns}
+    if (len(set(header)) < len(header) or None in types.values() or not set(read_csv_args) <= ARROW_READ_ARGS
+            or read_csv_args.get('on_bad_lines', 'error') not in ('error', 'skip')):
+        return None
+    on_bad_record = skip_long_record if read_csv_args.get('on_bad_lines') == 'skip' else None
+    try:
+        table = pa_csv.read_csv(
+            file_path,
+            read_options=pa_csv.ReadOptions(encoding=encoding),
+            parse_options=pa_csv.ParseOptions(delimiter=sep, newlines_in_values=True, invalid_row_handler=on_bad_record),
+            convert_options=pa_csv.ConvertOptions(column_types=types, include_columns=columns, null_values=NA_VALUES,
+                                                  strings_can_be_null=True))
+    except pa.ArrowInvalid:
+        return None
+    data = table.to_pandas()
+    # pandas sorts the categories it reads; pyarrow keeps them in order of appearance
+    for column in data.columns:
+        if isinstance(data[column].dtype, pd.CategoricalDtype):
+            data[column] = data[column].cat.reorder_categories(sorted(data[column].cat.categories))
+    return data
+
+# Function to load an occurrence file with the registry dtypes. Required columns are checked
+# against the header first; usecols limits the columns that are parsed. default_dtype fixes the
+# dtype of columns outside the registry, which keeps them the same across chunks when reading
+# with chunksize; dtype entries override the registry for the columns they name. If a numeric
+# field holds values that aren't numbers, the file is read again with pandas inferring that
+# field. With chunksize, returns an iterator of chunks (always read with pandas).
+def read_occurrences(file_path, required=(), usecols=None, sep=',', encoding='ISO-8859-1', default_dtype=None, dtype=None,
+                     **read_csv_args):
+    header = read_header(file_path, sep=sep, encoding=encoding)
+    check_required_columns(header, required, file_path)
+
+    # Columns named in usecols that the file doesn't have are skipped
+    if usecols is not None:
+        usecols = [column for column in header if column in set(usecols)]
+    dtype = dwc_dtypes(usecols if usecols is not None else header, default_dtype, dtype)
+    read_csv_args.setdefault('low_memory', False)
+    if read_csv_args.get('chunksize'):
+        # Chunks are parsed as they're read, so the fallback has to wrap the iteration
+        return read_occurrence_chunks(file_path, usecols, sep, encoding, dtype, read_csv_args)
+    data = read_with_arrow(file_path, header, usecols, sep, encoding, dtype, read_csv_args)
+    if data is not None:
+        return data
+    try:
+        return pd.read_csv(file_path, sep=sep, encoding=encoding, usecols=usecols, dtype=dtype, **read_csv_args)
+    except ValueError as e:
+        numeric = fixed_numeric_columns(dtype)
+        if not numeric:
+            raise
+        print(f"Warning: {e} in {file_path}; reading {', '.join(numeric)} without a fixed dtype")
+        dtype = {column: value for column, value in dtype.items() if column not in numeric}
+        return pd.read_csv(file_path, sep=sep, encoding=encoding, usecols=usecols, dtype=dtype, **read_csv_args)
@@ -14,6 +14,9 @@ from tqdm import tqdm
 import re
 import argparse
 from pathlib import Path
+from dwc_schema import read_occurrences
+from parallel_reader import read_occurrences_parallel
+from blacklist_matcher import load_blacklists, blacklisted_records
 
 def arg_setup():
     # set up argument parser
@@ -24,6 +27,10 @@ def arg_setup():
         help="Output directory path for multiple CSV files.")
     ap.add_argument("-v", "--verbose", action="store_true", \
         help="Detailed output.")
+    ap.add_argument("-g", "--georeference-blacklists", action="store_true", \
+        help="Also drop records on the georeference blacklists in Chopper_Config.txt (whitelisted collections bypass them).")
+    ap.add_argument("-p", "--processes", type=int, default=1, \
+        help="Processes that parse the input file in parallel byte ranges.")
     args = vars(ap.parse_args())
     return args
 
@@ -152,18 +159,22 @@ def split_csv_by_state():
 
     try:
         #data = pd.read_csv(input_csv, encoding='ISO-8859-1', dtype=str, on_bad_lines='skip', low_memory=False)
-        data = pd.read_csv(input_csv, on_bad_lines='skip', low_memory=False)
+        # Raises a ValueError before parsing if stateProvince, county or collectionCode is missing.
+        # Columns outside the registry are read as text, so -p doesn't change how they are written out.
+        if args['processes'] > 1:
+            data = read_occurrences_parallel(input_csv, required=['stateProvince', 'county', 'collectionCode'], encoding='utf-8',
+                                             on_bad_lines='skip', default_dtype=str, processes=args['processes'])
+        else:
+            data = read_occurrences(input_csv, required=['stateProvince', 'county', 'collectionCode'], encoding='utf-8',
+                                    on_bad_lines='skip', default_dtype=str)
     except (UnicodeDecodeError, pd.errors.ParserError) as e:
         print(f"Error reading the file: {e}")
         return
 
-    if 'stateProvince' not in data.columns or 'county' not in data.columns or 'collectionCode' not in data.columns:
-        raise ValueError("The CSV file must contain 'stateProvince', 'county', and 'collectionCode' columns.")
-
     # Run the pre-check for missing collectionCode
     #data = count_null_collectioncode(data)
 
-    data['normalized_county'] = data['county'].apply(normalize_county_name)
+    data['normalized_county'] = data['county'].astype(object).apply(normalize_county_name)
 
     # Apply whitelist/blacklist filter for collectionCode
     data['collectionCode'] = data['collectionCode'].astype(str)
@@ -196,7 +207,7 @@ def split_csv_by_state():
 
     print(f"Files created in directory: {output_dir}")
 
-def filter_data(data=None, collection_whitelist=None, collection_blacklist=None):
+def filter_data(data=None, collection_whitelist=None, collection_blacklist=None, blacklists=None):
     if 'stateProvince' not in data.columns or 'county' not in data.columns or 'collectionCode' not in data.columns:
         # This error was raised when a TSV was opened as a CSV
         print('columns:', data.columns)
@@ -221,6 +232,11 @@ def filter_data(data=None, collection_whitelist=None, collection_blacklist=None)
     data = data[~data['collectionCode'].isin(collection_blacklist)]
     print('Blacklist removed data shape:', data.shape)
 
+    # Exclude records on the georeference blacklists
+    if blacklists:
+        data = data[~blacklisted_records(data, blacklists)]
+        print('Georeference blacklist removed data shape:', data.shape)
+
     # Combine the filtered data with the whitelisted data that bypasses all filters
     final_data = pd.concat([whitelist_data, data])
     print('final_data (whitelist_data concat data) shape', final_data.shape)
@@ -276,12 +292,22 @@ if __name__ == "__main__":
     print('Loading data...')
     try:
         #data = pd.read_csv(input_csv, encoding='ISO-8859-1', dtype=str, on_bad_lines='skip', low_memory=False)
-        # Loading TSV format
-        df_data = pd.read_csv(input_csv, on_bad_lines='skip', low_memory=False, sep='\t')
+        # Loading TSV format (raises a ValueError before parsing if a required column is missing).
+        # Columns outside the registry are read as text, as in split_csv_by_state.
+        if args['processes'] > 1:
+            df_data = read_occurrences_parallel(input_csv, required=['stateProvince', 'county', 'collectionCode'], sep='\t',
+                                                encoding='utf-8', on_bad_lines='skip', default_dtype=str,
+                                                processes=args['processes'])
+        else:
+            df_data = read_occurrences(input_csv, required=['stateProvince', 'county', 'collectionCode'], sep='\t',
+                                       encoding='utf-8', on_bad_lines='skip', default_dtype=str)
     except (UnicodeDecodeError, pd.errors.ParserError) as e:
         print(f"Error reading the file: {e}")
         df_data = None
 
     print('Input data shape', df_data.shape)
-    df_filtered = filter_data(data=df_data, collection_whitelist=collection_whitelist, collection_blacklist=collection_blacklist)
+    # Georeference blacklists from Chopper_Config.txt, compiled once
+    blacklists = load_blacklists(config_file_path) if args['georeference_blacklists'] else None
+    df_filtered = filter_data(data=df_data, collection_whitelist=collection_whitelist, collection_blacklist=collection_blacklist,
+                              blacklists=blacklists)
     print('Filtered data shape', df_filtered.shape)
\ No newline at end of file
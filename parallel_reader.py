@@ -0,0 +1,143 @@
+"""
+Parallel reader for state-sized occurrence files.
+
+The file is memory-mapped and cut into byte ranges that start and end on record
+boundaries, and the ranges are parsed in a process pool. A newline only ends a
+record when the number of quote characters since the last boundary is even, so
+quoted newlines in locality and habitat fields never split a record. This holds
+for files written by a CSV writer, which quotes any field holding a quote and
+doubles the quote inside it. Pass quoting=csv.QUOTE_NONE for files without
+quoting, and every newline ends a record.
+
+read_partitions yields the parsed ranges in file order; read_occurrences_parallel
+joins them into one frame with the same rows and index as read_occurrences. The
+registry columns get the same dtypes too, but pandas infers any other column per
+range, so a column can come back as numbers in one range and text in another
+("1.50" and 1.5). Pass default_dtype (e.g. str) to fix those columns as well;
+with it, the frame has the same dtypes as read_occurrences.
+
+"""
+
+import csv
+import io
+import mmap
+import os
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from dwc_schema import read_occurrences, read_header, check_required_columns, dwc_dtypes, fixed_numeric_columns
+
+# Files smaller than this are read in one go; ranges are at least this large
+MIN_RANGE_BYTES = 32 << 20
+
+# Bytes scanned at a time when counting quotes between boundaries
+SCAN_BLOCK_BYTES = 16 << 20
+
+# Function to count the quote characters in mm[start:stop] without copying the whole span at once
+def count_quotes(mm, start, stop):
+    quotes = 0
+    for block in range(start, stop, SCAN_BLOCK_BYTES):
+        quotes += mm[block:min(block + SCAN_BLOCK_BYTES, stop)].count(b'"')
+    return quotes
+
+# Function to find the start of the first record after position. quotes is the number of quote
+# characters between the previous record boundary and position. Returns the file size when no
+# record starts after position.
+def next_record_start(mm, position, quotes=0, quoted=True):
+    while True:
+        newline = mm.find(b'\n', position)
+        if newline == -1:
+            return len(mm)
+        if quoted:
+            quotes += count_quotes(mm, position, newline)
+        position = newline + 1
+        if quotes % 2 == 0:
+            return position
+
+# Function to split a file into about `parts` byte ranges that each hold whole records. The
+# header record is left out. Returns a list of (start, stop) offsets in file order.
+def find_record_ranges(file_path, parts, quoted=True):
+    with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        size = len(mm)
+        starts = [next_record_start(mm, 0, quoted=quoted)]
+        for part in range(1, parts):
+            target = starts[0] + part * (size - starts[0]) // parts
+            if target <= starts[-1]:
+                continue
+            # Quote parity is even at every boundary, so count from the last one
+            quotes = count_quotes(mm, starts[-1], target) if quoted else 0
+            start = next_record_start(mm, target, quotes, quoted)
+            if start < size:
+                starts.append(start)
+    return [(start, stop) for start, stop in zip(starts, starts[1:] + [size]) if stop > start]
+
+# Function to parse a run of whole records (without the header) into a frame. If a numeric field
+# holds values that aren't numbers, the records are parsed again with pandas inferring that
+# field, as read_occurrences does for a whole file. source names the records in the warning.
+def parse_records(data, names, sep, encoding, usecols, dtype, read_csv_args, source):
+    try:
+        return pd.read_csv(io.BytesIO(data), sep=sep, encoding=encoding, header=None, names=names,
+                           usecols=usecols, dtype=dtype, **read_csv_args)
+    except ValueError as e:
+        numeric = fixed_numeric_columns(dtype)
+        if not numeric:
+            raise
+        print(f"Warning: {e} in {source}; reading {', '.join(numeric)} without a fixed dtype")
+        dtype = {column: value for column, value in dtype.items() if column not in numeric}
+        return pd.read_csv(io.BytesIO(data), sep=sep, encoding=encoding, header=None, names=names,
+                           usecols=usecols, dtype=dtype, **read_csv_args)
+
+# Function to parse the records in one byte range of a file (runs in a worker process)
+def read_byte_range(file_path, start, stop, names, sep, encoding, usecols, dtype, read_csv_args):
+    with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        data = mm[start:stop]
+    return parse_records(data, names, sep, encoding, usecols, dtype, read_csv_args, f"bytes {start}-{stop} of {file_path}")
+
+# Function to parse a file's byte ranges in a process pool and yield the frames in file order.
+# Columns are checked and typed the same way as read_occurrences; each frame is indexed by the
+# row positions of its records in the file. processes defaults to every core.
+def read_partitions(file_path, required=(), usecols=None, sep=',', encoding='ISO-8859-1', default_dtype=None,
+                    dtype=None, processes=None, **read_csv_args):
+    header = read_header(file_path, sep=sep, encoding=encoding)
+    check_required_columns(header, required, file_path)
+    if usecols is not None:
+        usecols = [column for column in header if column in set(usecols)]
+    overrides = dtype
+    dtype = dwc_dtypes(usecols if usecols is not None else header, default_dtype, overrides)
+    read_csv_args.setdefault('low_memory', False)
+
+    processes = processes or os.cpu_count() or 1
+    parts = max(1, min(processes * 4, os.path.getsize(file_path) // MIN_RANGE_BYTES))
+    ranges = find_record_ranges(file_path, parts, quoted=read_csv_args.get('quoting') != csv.QUOTE_NONE)
+
+    if len(ranges) < 2:
+        # Too small to split: parse it in this process
+        yield read_occurrences(file_path, usecols=usecols, sep=sep, encoding=encoding, default_dtype=default_dtype,
+                               dtype=overrides, **read_csv_args)
+        return
+
+    with ProcessPoolExecutor(max_workers=min(processes, len(ranges))) as pool:
+        futures = [pool.submit(read_byte_range, file_path, start, stop, header, sep, encoding, usecols, dtype, read_csv_args)
+                   for start, stop in ranges]
+        rows = 0
+        for future in futures:
+            frame = future.result()
+            frame.index = pd.RangeIndex(rows, rows + len(frame))
+            rows += len(frame)
+            yield frame
+
+# Function to load an occurrence file with its byte ranges parsed in parallel: one row per record
+# in file order, with a RangeIndex. Columns outside the registry only match read_occurrences when
+# default_dtype is given, since otherwise each range infers their dtype on its own.
+def read_occurrences_parallel(file_path, required=(), usecols=None, sep=',', encoding='ISO-8859-1', default_dtype=None,
+                              dtype=None, processes=None, **read_csv_args):
+    frames = list(read_partitions(file_path, required=required, usecols=usecols, sep=sep, encoding=encoding,
+                                  default_dtype=default_dtype, dtype=dtype, processes=processes, **read_csv_args))
+    if len(frames) == 1:
+        return frames[0]
+    data = pd.concat(frames)
+
+    # Ranges observe different categories, which concat turns into object columns
+    categories = [column for column in data.columns if isinstance(frames[0][column].dtype, pd.CategoricalDtype)]
+    if categories:
+        data = data.astype({column: 'category' for column in categories})
+    return data